@@ -1,11 +1,15 @@
 import os
+import time
 import argparse
 import asyncio
 import pwinput
-from typing import Dict, Any, Optional, List
-from dotenv import load_dotenv
+import orjson
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, Any, Iterable, Iterator, Optional, List, Tuple, Union
 
 from src.bulk_changes.create_commands import (
+    clear_lookup_cache,
     create_command_delete_things,
     create_commands_tags,
     create_commands_settings,
@@ -14,13 +18,23 @@ from src.bulk_changes.create_commands import (
     create_commands_device_profile,
     create_commands_delete_tag,
 )
-from src.bulk_changes.get_data import read_imei_and_setting, read_imei_only
+from src.bulk_changes.env import load_env
 from src.logger.logger import Logger
-from src.oneEdge.oneEdgeApi import OneEdgeApi, OneEdgeApiError
-from src.bulk_changes.undeploy_process import undeploy_process
+from src.oneEdge.oneEdgeApi import AuthState, OneEdgeApi, OneEdgeApiError
+
+# get_data (pandas) and undeploy_process (paramiko) are imported inside the handlers that use
+# them, so --help and argument errors do not pay for loading them
 
 logger = Logger(__name__)
-load_dotenv("config/.env")
+
+COMMAND_BATCH_SIZE: int = 500
+MAX_CONCURRENT_BATCHES: int = 16
+SESSION_CACHE_FILE: Path = Path.home() / ".cache" / "bulk_changes" / "session.json"
+SESSION_CACHE_TTL: int = 3600
+
+# Errors a command can fail with and still let the CLI report it and clean up;
+# anything else (including cancellation) propagates
+_RECOVERABLE = (OSError, OneEdgeApiError, ValueError, KeyError)
 
 
 async def add_settings(file_path: str) -> Optional[Dict[str, Any]]:
@@ -30,16 +44,18 @@ async def add_settings(file_path: str) -> Optional[Dict[str, Any]]:
     :param file_path: Path to the input file containing IMEI numbers and settings.
     :return: A dictionary containing the created commands, or None if an error occurs.
     """
+    from src.bulk_changes.get_data import read_imei_and_setting
+
     try:
         logger.info("Reading the file...")
         ids, settings = await read_imei_and_setting(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
         logger.info("Creating commands...")
-        commands_json = await create_commands_settings(ids, settings)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_commands_settings(ids, settings)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing add settings: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing add settings: %s", e)
         return None
 
 
@@ -53,16 +69,18 @@ async def apply_device_profile(
     :param profile_id: The ID of the profile to apply.
     :return: A dictionary containing the created commands, or None if an error occurs.
     """
+    from src.bulk_changes.get_data import read_imei_only
+
     try:
         logger.info("Reading the file...")
         ids = await read_imei_only(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
         logger.info("Creating commands...")
-        commands_json = await create_commands_device_profile(ids, profile_id)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_commands_device_profile(ids, profile_id)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing apply device profile: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing apply device profile: %s", e)
         return None
 
 
@@ -74,16 +92,18 @@ async def add_tags(file_path: str, tags: List[str]) -> Optional[Dict[str, Any]]:
     :param tags: List of tags to add to the devices.
     :return: A dictionary containing the created commands, or None if an error occurs.
     """
+    from src.bulk_changes.get_data import read_imei_only
+
     try:
         logger.info("Reading the file...")
         ids = await read_imei_only(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
         logger.info("Creating commands...")
-        commands_json = await create_commands_tags(ids, tags)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_commands_tags(ids, tags)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing add tags: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing add tags: %s", e)
         return None
 
 
@@ -97,16 +117,18 @@ async def change_thing_definition(
     :param thing_key: The new thing definition key to apply.
     :return: A dictionary containing the created commands, or None if an error occurs.
     """
+    from src.bulk_changes.get_data import read_imei_only
+
     try:
         logger.info("Reading the file...")
         ids = await read_imei_only(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
         logger.info("Creating commands...")
-        commands_json = await create_commands_thing_def(ids, thing_key)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_commands_thing_def(ids, thing_key)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing change thing definition: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing change thing definition: %s", e)
         return None
 
 
@@ -117,10 +139,13 @@ async def undeploy_devices(file_path: str) -> Optional[Dict[str, Any]]:
     :param file_path: Path to the input file containing IMEI numbers.
     :return: A dictionary containing the created commands, or None if an error occurs.
     """
+    from src.bulk_changes.get_data import read_imei_only
+    from src.bulk_changes.undeploy_process import undeploy_process
+
     try:
         logger.info("Reading the file...")
         ids = await read_imei_only(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
 
         # Perform the undeploy process
         logger.info("Starting undeploy process...")
@@ -128,11 +153,11 @@ async def undeploy_devices(file_path: str) -> Optional[Dict[str, Any]]:
         logger.info("Undeploy process completed.")
 
         logger.info("Creating oneEdge undeploy commands...")
-        commands_json = await create_commands_undeploy(ids)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_commands_undeploy(ids)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing undeploy devices: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing undeploy devices: %s", e)
         return None
 
 
@@ -144,16 +169,18 @@ async def delete_tags(file_path: str, tags: List[str]) -> Optional[Dict[str, Any
     :param tags: List of tags to delete from the devices.
     :return: A dictionary containing the created commands, or None if an error occurs.
     """
+    from src.bulk_changes.get_data import read_imei_only
+
     try:
         logger.info("Reading the file...")
         ids = await read_imei_only(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
         logger.info("Creating commands...")
-        commands_json = await create_commands_delete_tag(ids, tags)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_commands_delete_tag(ids, tags)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing delete tags: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing delete tags: %s", e)
         return None
 
 
@@ -166,11 +193,11 @@ async def delete_things_by_tags(tags: List[str]) -> Optional[Dict[str, Any]]:
     """
     try:
         logger.info("Creating commands to delete things based on tags...")
-        commands_json = await create_command_delete_things(tags=tags)
-        logger.info(f"Created commands for deleting things with tags: {tags}.")
+        commands_json = create_command_delete_things(tags=tags)
+        logger.info("Created commands for deleting things with tags: %s.", tags)
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing delete things by tags: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing delete things by tags: %s", e)
         return None
 
 
@@ -180,102 +207,284 @@ async def delete_things_by_keys(file_path: str) -> Optional[Dict[str, Any]]:
 
     :param file_path: Path to the input file containing IMEI numbers.
     :return: A dictionary containing the created commands, or None if an error occurs.
-
     """
+    from src.bulk_changes.get_data import read_imei_only
+
     try:
         logger.info("Reading the file...")
         ids = await read_imei_only(file_path)
-        logger.info(f"Read {len(ids)} devices from the file.")
+        logger.info("Read %d devices from the file.", len(ids))
         logger.info("Creating commands...")
-        commands_json = await create_command_delete_things(thing_keys=ids)
-        logger.info(f"Created commands for {len(commands_json)} devices.")
+        commands_json = create_command_delete_things(thing_keys=ids)
+        logger.info("Created commands for %d devices.", len(commands_json))
         return commands_json
-    except Exception as e:
-        logger.error(f"Error processing delete things by keys: {e}")
+    except _RECOVERABLE as e:
+        logger.error("Error processing delete things by keys: %s", e)
         return None
 
 
-async def process_commands(api: OneEdgeApi, commands: Dict[str, Any]) -> Dict[str, Any]:
+def chunk_commands(
+    commands: Union[Dict[str, Any], Iterable[Tuple[str, Any]]], size: int = COMMAND_BATCH_SIZE
+) -> Iterator[Dict[str, Any]]:
+    """
+    Splits the commands into batches of at most `size` entries, keeping their keys.
+
+    :param commands: A dictionary of commands, or an iterator of (key, command) pairs such as
+                     the iter_commands_* builders return.
+    :param size: The maximum number of commands per batch.
+    :return: An iterator over the command batches.
+    """
+    items = iter(commands.items() if isinstance(commands, dict) else commands)
+    batch = dict(islice(items, size))
+    while batch:
+        yield batch
+        batch = dict(islice(items, size))
+
+
+async def process_commands(
+    api: OneEdgeApi,
+    commands: Dict[str, Any],
+    batch_size: int = COMMAND_BATCH_SIZE,
+    concurrency: int = MAX_CONCURRENT_BATCHES,
+) -> Dict[str, Any]:
     """
     Processes the given commands by publishing them to the oneEdge API.
 
+    Large command sets are sent as concurrent batches and the results merged back together.
+
     :param api: An authenticated instance of OneEdgeApi.
     :param commands: A dictionary containing the commands to be processed.
+    :param batch_size: The maximum number of commands sent in one request.
+    :param concurrency: The maximum number of requests in flight at once.
     :return: A dictionary containing the results of the command execution.
     :raises OneEdgeApiError: If there is an error in publishing the commands.
     """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_batch(batch: Dict[str, Any]) -> Dict[str, Any]:
+        async with semaphore:
+            return await api.run_commands(batch)
+
+    batches = list(chunk_commands(commands, batch_size))
+    batch_results = await asyncio.gather(
+        *(run_batch(batch) for batch in batches), return_exceptions=True
+    )
+
+    failures = [r for r in batch_results if isinstance(r, OneEdgeApiError)]
+    if failures and len(failures) == len(batches):
+        logger.error("Error publishing commands: %s", failures[0])
+        raise failures[0]
+
+    results: Dict[str, Any] = {"success": True, "errorCodes": []}
+    for batch, batch_result in zip(batches, batch_results):
+        if isinstance(batch_result, OneEdgeApiError):
+            logger.error("Error publishing commands: %s", batch_result)
+            results["success"] = False
+            for key in batch:
+                results[key] = {"success": False, "errorCodes": []}
+            continue
+        if isinstance(batch_result, BaseException):
+            raise batch_result
+
+        results["success"] = results["success"] and batch_result.pop("success", True)
+        results["errorCodes"].extend(batch_result.pop("errorCodes", []))
+        results.update(batch_result)
+
+    return results
+
+
+def _read_session_cache() -> Dict[str, Dict[str, Any]]:
+    """
+    Reads the cached sessions of all API URLs.
+
+    :return: The cache entries keyed by API URL, or an empty dict if the file is missing or unreadable.
+    """
     try:
-        results: Dict[str, Any] = await api.run_commands(commands)
-        return results
+        # orjson.JSONDecodeError is a ValueError
+        return orjson.loads(SESSION_CACHE_FILE.read_bytes())
+    except (OSError, ValueError):
+        return {}
+
+
+def _load_cached_session(url: str) -> Optional[str]:
+    """
+    Loads a previously stored session id for the given API URL.
+
+    :param url: The oneEdge API URL the session belongs to.
+    :return: The cached session id, or None if there is no unexpired entry.
+    """
+    entry = _read_session_cache().get(url, {})
+    if entry.get("expires", 0) < time.time():
+        return None
+    return entry.get("session_id")
+
+
+def _store_cached_session(url: str, session_id: str, ttl: int = SESSION_CACHE_TTL) -> bool:
+    """
+    Stores the session id for the given API URL so later runs can reuse it.
+
+    :param url: The oneEdge API URL the session belongs to.
+    :param session_id: The authenticated session id.
+    :param ttl: Number of seconds the cached session stays valid.
+    :return: True if the session was cached, False if the cache file could not be written.
+    """
+    sessions = _read_session_cache()
+    sessions[url] = {"session_id": session_id, "expires": time.time() + ttl}
+    tmp_file = SESSION_CACHE_FILE.with_suffix(".tmp")
+    try:
+        SESSION_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        # The session id grants API access, keep it readable by the owner only
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(sessions))
+        os.replace(tmp_file, SESSION_CACHE_FILE)
+    except OSError as e:
+        logger.warning("Could not cache session: %s", e)
+        return False
+    return True
+
+
+async def _end_replaced_session(api: OneEdgeApi, session_id: str) -> None:
+    """
+    Ends a previously cached session on the server once a new login has taken its place.
+
+    :param api: The API object, logged in with the new session.
+    :param session_id: The id of the session that was replaced.
+    """
+    try:
+        result = await api.run_command(
+            {"command": "session.end", "params": {"id": session_id}}
+        )
     except OneEdgeApiError as e:
-        logger.error(f"Error publishing commands: {e}")
-        raise
+        logger.warning("Could not end the replaced session: %s", e)
+        return
+    if not result.get("success"):
+        logger.warning(
+            "Could not end the replaced session: %s", result.get("errorCodes")
+        )
 
 
-async def authenticate_user() -> OneEdgeApi:
+async def authenticate_user(new_session: bool = False) -> OneEdgeApi:
     """
     Authenticates the user with the oneEdge API using environment variables for credentials.
 
+    A session cached by a previous run is reused when the API still accepts it.
+
+    :param new_session: Ignore any cached session and always log in again.
     :return: An instance of OneEdgeApi with the user authenticated.
     :raises OneEdgeApiError: If authentication fails.
+    :raises ValueError: If ONEEDGE_GZIP_MIN_SIZE is set but not a whole number.
     """
+    load_env()
     try:
-        api = OneEdgeApi(os.getenv("API_URL"))
+        url: str = os.getenv("API_URL")
+        # Request compression stays off unless a size threshold is configured
+        gzip_min_size: str = os.getenv("ONEEDGE_GZIP_MIN_SIZE", "")
+        api = OneEdgeApi(url, gzip_min_size=int(gzip_min_size) if gzip_min_size else None)
+
+        cached_session_id = _load_cached_session(url)
+        if cached_session_id and not new_session:
+            api.session_id = cached_session_id
+            try:
+                await api.verify_auth_state()
+                if api.auth_state == AuthState.AUTHENTICATED:
+                    logger.info("Reusing cached session.")
+                    return api
+                # The API no longer accepts the session, so it does not need ending
+                cached_session_id = None
+            except OneEdgeApiError as e:
+                logger.warning("Could not verify cached session: %s", e)
+                api.session_id = None
+
         username: str = os.getenv("TELIT_USERNAME", "")
         password: str = os.getenv("TELIT_PASSWORD", "")
         if not username:
-            username = input("Enter Telit Username: ")
-            password = pwinput.pwinput(prompt="Enter Telit Password: ")
-
-        await api.authenticate_user(
+            # Connect to the API host while the user types, the login does not wait for it
+            prewarm = asyncio.create_task(api.prewarm())
+            try:
+                username = await asyncio.to_thread(input, "Enter Telit Username: ")
+                password = await asyncio.to_thread(
+                    pwinput.pwinput, prompt="Enter Telit Password: "
+                )
+            finally:
+                prewarm.cancel()
+
+        if await api.authenticate_user(
             username=username,
             password=password
-        )
+        ):
+            # A cached session that may still be live is ended once the new one replaces it
+            if _store_cached_session(url, api.session_id) and cached_session_id:
+                await _end_replaced_session(api, cached_session_id)
 
         logger.info("User authenticated successfully.")
         return api
 
     except OneEdgeApiError as e:
-        logger.error(f"Authentication failed: {e}")
+        logger.error("Authentication failed: %s", e)
         raise
 
 
-async def close_api_session(api: Any) -> None:
+async def close_api_session(api: Any, end_session: bool = True) -> None:
     """
     Closes the API session.
 
     :param api: The API object.
+    :param end_session: Whether to end the session on the server. When False the session
+                        stays valid so it can be reused by the next run.
     :raises Exception: If there is an error closing the session.
 
     Example:
         await close_api_session(api)
     """
+    clear_lookup_cache()
     try:
-        session: Dict[str, Dict[str, bool]] = await api.close_session()
-        if session.get("success", False):
+        if not end_session:
+            return
+        session: Optional[Dict[str, Any]] = await api.close_session()
+        if session and session.get("success", False):
             logger.info("Session closed successfully.")
         else:
             logger.warning("Failed to close session properly.")
     except Exception as e:
-        logger.error(f"Error closing session: {e}")
+        logger.error("Error closing session: %s", e)
         raise
+    finally:
+        await api.aclose()
 
 
 async def execute_command(
-    command_func: callable, *args, **kwargs
+    command_func: callable, *args, new_session: bool = False, **kwargs
 ) -> Optional[Dict[str, Any]]:
     """
     Executes the provided command function with the given arguments and handles the session.
 
     :param command_func: The function to execute.
     :param args: Arguments to pass to the function.
+    :param new_session: Log in again instead of reusing a cached session.
     :param kwargs: Keyword arguments to pass to the function.
     :return: The result of the command function or None if an error occurs.
     """
     api = None
     try:
-        api = await authenticate_user()
-        commands = await command_func(*args, **kwargs)
+        load_env()
+        # Undeploying changes the remote database, only start once logged in. Without credentials
+        # in the environment the user is prompted, and the file's log lines would interrupt that
+        if command_func is undeploy_devices or not os.getenv("TELIT_USERNAME"):
+            api = await authenticate_user(new_session)
+            commands = await command_func(*args, **kwargs)
+        else:
+            # Reading the file and building commands does not need the API, overlap it with login
+            auth_result, commands = await asyncio.gather(
+                authenticate_user(new_session),
+                command_func(*args, **kwargs),
+                return_exceptions=True,
+            )
+            if not isinstance(auth_result, BaseException):
+                api = auth_result
+            for outcome in (auth_result, commands):
+                if isinstance(outcome, BaseException):
+                    raise outcome
         if commands:
             logger.info("Command execution successful, publishing commands...")
             result = await process_commands(api, commands)
@@ -284,12 +493,29 @@ async def execute_command(
         else:
             logger.error("Command execution returned no result.")
             return None
-    except Exception as e:
-        logger.error(f"An error occurred: {e}")
+    except _RECOVERABLE as e:
+        logger.error("An error occurred: %s", e)
         return None
     finally:
         if api:
-            await close_api_session(api)
+            # The session cached for the next run stays alive on the server, any other is ended
+            keep_session = api.session_id is None or (
+                api.session_id == _load_cached_session(api.endpoint_url)
+            )
+            await close_api_session(api, end_session=not keep_session)
+
+
+# Sub-command name -> (command function, names of the parsed arguments it takes)
+DISPATCH: Dict[str, Tuple[Callable[..., Any], Tuple[str, ...]]] = {
+    "add-settings": (add_settings, ("file_path",)),
+    "apply-profile": (apply_device_profile, ("file_path", "profile_id")),
+    "add-tags": (add_tags, ("file_path", "tags")),
+    "change-def": (change_thing_definition, ("file_path", "thing_key")),
+    "undeploy": (undeploy_devices, ("file_path",)),
+    "delete-tags": (delete_tags, ("file_path", "tags")),
+    "delete-things-tags": (delete_things_by_tags, ("tags",)),
+    "delete-things-keys": (delete_things_by_keys, ("file_path",)),
+}
 
 
 async def main():
@@ -302,6 +528,12 @@ async def main():
         description="Command Line Tool for Device Management"
     )
 
+    parser.add_argument(
+        "--new-session",
+        action="store_true",
+        help="Log in again instead of reusing the cached session",
+    )
+
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     # Add Settings Command
@@ -380,31 +612,25 @@ async def main():
 
     args = parser.parse_args()
 
-    try:
-        if args.command == "add-settings":
-            await execute_command(add_settings, args.file_path)
-        elif args.command == "apply-profile":
-            await execute_command(apply_device_profile, args.file_path, args.profile_id)
-        elif args.command == "add-tags":
-            await execute_command(add_tags, args.file_path, args.tags)
-        elif args.command == "change-def":
-            await execute_command(
-                change_thing_definition, args.file_path, args.thing_key
-            )
-        elif args.command == "undeploy":
-            await execute_command(undeploy_devices, args.file_path)
-        elif args.command == "delete-tags":
-            await execute_command(delete_tags, args.file_path, args.tags)
-        elif args.command == "delete-things-tags":
-            await execute_command(delete_things_by_tags, args.tags)
-        elif args.command == "delete-things-keys":
-            await execute_command(delete_things_by_keys, args.file_path)
-        else:
-            parser.print_help()
+    command_func, arg_names = DISPATCH.get(args.command, (None, ()))
+    if command_func is None:
+        parser.print_help()
+        return
 
+    try:
+        await execute_command(
+            command_func,
+            *(getattr(args, name) for name in arg_names),
+            new_session=args.new_session,
+        )
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop  # Not available on Windows, fall back to the default loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())
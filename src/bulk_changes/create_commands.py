@@ -1,13 +1,77 @@
-from typing import List, Dict, Optional, Any, Union
+from typing import Iterable, Iterator, List, Dict, Optional, Any, Tuple, Union
+
+from cachetools import TTLCache
+
 from src.oneEdge.oneEdgeApi import OneEdgeApi, OneEdgeApiError
 from src.logger.logger import Logger
 
 logger = Logger(__name__)
 
+# Number of entries requested per page when listing profiles or thing definitions
+LIST_PAGE_SIZE: int = 500
+# Most pages fetched for one list, in case the server ignores the offset
+LIST_PAGE_LIMIT: int = 100
+
+# What a thing definition change drops from each device: attributes and alarms, but not properties
+_THING_DEF_FLAGS: Dict[str, bool] = {"dropProps": False, "dropAttrs": True, "dropAlarms": True}
+# Undeploying clears the attribute that tells a device where to send its data
+_UNDEPLOY_PARAMS: Dict[str, str] = {"key": "data_destination", "value": ""}
+
+# Name -> value mappings of listed profiles and thing definitions, keyed on (session id, command)
+_lookup_cache: TTLCache = TTLCache(maxsize=32, ttl=600)
+
+
+def clear_lookup_cache() -> None:
+    """
+    Clears the cached profile and thing definition lookups.
+    """
+    _lookup_cache.clear()
+
+
+async def _get_name_map(one_edge_api: OneEdgeApi, command: str, value_field: str) -> Dict[str, Any]:
+    """
+    Lists every entry of a oneEdge list command and maps entry names to one of their fields.
+
+    The mapping is fetched page by page on first use and cached per session for ten minutes.
+
+    :param one_edge_api: Instance of OneEdgeApi.
+    :param command: The list command to run, e.g. "thing_def.list".
+    :param value_field: The field of each entry to map its name to.
+    :return: A dictionary mapping entry names to the requested field.
+    :raises OneEdgeApiError: If there's an error communicating with the API or the list command fails.
+    """
+    cache_key = (one_edge_api.session_id, command)
+    if cache_key in _lookup_cache:
+        return _lookup_cache[cache_key]
+
+    name_map: Dict[str, Any] = {}
+    for page_number in range(LIST_PAGE_LIMIT):
+        response = await one_edge_api.run_command(
+            {"command": command, "params": {"limit": LIST_PAGE_SIZE, "offset": page_number * LIST_PAGE_SIZE}}
+        )
+        # A failed list is raised rather than cached, so the next lookup asks the API again
+        if not response.get("success", True):
+            raise OneEdgeApiError(f"{command} failed with error codes {response.get('errorCodes')}")
+
+        page = response.get("params", {}).get("result", [])
+        names_before = len(name_map)
+        for entry in page:
+            if "name" in entry and value_field in entry:
+                name_map.setdefault(entry["name"], entry[value_field])
+
+        # A short page is the last one, and a page without new names means the offset was ignored
+        if len(page) < LIST_PAGE_SIZE or len(name_map) == names_before:
+            break
+    else:
+        logger.warning("Stopped listing %s after %d pages.", command, LIST_PAGE_LIMIT)
+
+    _lookup_cache[cache_key] = name_map
+    return name_map
+
 
 async def get_profile_id(one_edge_api: OneEdgeApi, profile_name: str) -> Optional[str]:
     """
-    Get profile ID from the oneEdge API.
+    Get profile ID from the oneEdge API. The profile list is cached per session for ten minutes.
 
     :param one_edge_api: Instance of OneEdgeApi.
     :param profile_name: Name of the profile to search for.
@@ -22,26 +86,21 @@ async def get_profile_id(one_edge_api: OneEdgeApi, profile_name: str) -> Optiona
             print("Profile not found.")
     """
     try:
-        response = await one_edge_api.run_command(
-            {"command": "lwm2m.profile.list", "params": {"limit": 100, "offset": 0}}
-        )
+        profile_ids = await _get_name_map(one_edge_api, "lwm2m.profile.list", "id")
+        profile_id = profile_ids.get(profile_name)
+        if profile_id is not None:
+            return profile_id
 
-        profile_list = response.get("params", {}).get("result", [])
-
-        for profile in profile_list:
-            if profile.get("name") == profile_name:
-                return profile["id"]
-
-        logger.warning(f"Profile name '{profile_name}' not found.")
+        logger.warning("Profile name '%s' not found.", profile_name)
         return None
     except OneEdgeApiError as e:
-        logger.error(f"Error while fetching profile: {e}")
+        logger.error("Error while fetching profile: %s", e)
         raise
 
 
 async def get_thing_def_key(one_edge_api: OneEdgeApi, thing_name: str) -> Optional[str]:
     """
-    Get thing definition key from the oneEdge API.
+    Get thing definition key from the oneEdge API. The definition list is cached per session for ten minutes.
 
     :param one_edge_api: Instance of OneEdgeApi.
     :param thing_name: Name of the thing definition to search for.
@@ -56,214 +115,264 @@ async def get_thing_def_key(one_edge_api: OneEdgeApi, thing_name: str) -> Option
             print("Thing definition not found.")
     """
     try:
-        response = await one_edge_api.run_command({"command": "thing_def.list"})
-
-        thing_def_list = response.get("params", {}).get("result", [])
+        thing_def_keys = await _get_name_map(one_edge_api, "thing_def.list", "key")
+        thing_def_key = thing_def_keys.get(thing_name)
+        if thing_def_key is not None:
+            return thing_def_key
 
-        for thing_def in thing_def_list:
-            if thing_def.get("name") == thing_name:
-                return thing_def["key"]
-
-        logger.warning(f"Thing definition name '{thing_name}' not found.")
+        logger.warning("Thing definition name '%s' not found.", thing_name)
         return None
     except OneEdgeApiError as e:
-        logger.error(f"Failed to get thing definition list: {e}")
+        logger.error("Failed to get thing definition list: %s", e)
         raise
 
 
-async def create_commands_tags(
-        imei_list: List[str], tags_list: List[str]
+def _iter_device_commands(
+        command: str,
+        thing_keys: Iterable[str],
+        params: Optional[Dict[str, Any]] = None,
+        key_field: str = "thingKey",
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yields one numbered command per device, each with its own copy of the shared parameters.
+
+    :param command: The oneEdge command name.
+    :param thing_keys: An iterable of IMEI numbers or thing keys, consumed once.
+    :param params: The parameters that are identical for every device.
+    :param key_field: The parameter name the device key is sent under.
+    :return: An iterator of (command key, command) pairs, numbered from "1".
+    """
+    params = params or {}
+    for i, thing_key in enumerate(thing_keys, 1):
+        yield str(i), {"command": command, "params": {key_field: thing_key, **params}}
+
+
+def iter_commands_tags(
+        imei_list: Iterable[str], tags_list: List[str]
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to add tags to devices, see create_commands_tags.
+
+    :param imei_list: An iterable of IMEI numbers, consumed once.
+    :param tags_list: A list of tags to add.
+    :return: An iterator of (command key, command) pairs.
+    """
+    return _iter_device_commands("thing.tag.add", imei_list, {"tags": list(tags_list)})
+
+
+def create_commands_tags(
+        imei_list: Iterable[str], tags_list: List[str]
 ) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to add tags to devices.
 
-    :param imei_list: A list of IMEI numbers.
+    :param imei_list: An iterable of IMEI numbers, consumed once.
     :param tags_list: A list of tags to add.
     :return: A dictionary containing the created commands.
 
     Example:
         imei_list = ["123456789012345", "987654321098765"]
         tags_list = ["sensor", "active"]
-        commands = await create_commands_tags(imei_list, tags_list)
+        commands = create_commands_tags(imei_list, tags_list)
         print(commands)
     """
-    try:
-        return {
-            str(i): {
-                "command": "thing.tag.add",
-                "params": {"thingKey": imei_number, "tags": tags_list},
-            }
-            for i, imei_number in enumerate(imei_list, 1)
-        }
-    except Exception as e:
-        logger.error(f"Error creating tag commands: {e}")
-        raise
+    return dict(iter_commands_tags(imei_list, tags_list))
+
+
+def iter_commands_device_profile(
+        imei_list: Iterable[str], profile_id: str
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to change device profiles, see create_commands_device_profile.
+
+    :param imei_list: An iterable of IMEI numbers, consumed once.
+    :param profile_id: The ID of the profile to apply.
+    :return: An iterator of (command key, command) pairs.
+    """
+    return _iter_device_commands("lwm2m.device.profile.change", imei_list, {"profileId": profile_id})
 
 
-async def create_commands_device_profile(
-        imei_list: List[str], profile_id: str
+def create_commands_device_profile(
+        imei_list: Iterable[str], profile_id: str
 ) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to change device profiles.
 
-    :param imei_list: A list of IMEI numbers.
+    :param imei_list: An iterable of IMEI numbers, consumed once.
     :param profile_id: The ID of the profile to apply.
     :return: A dictionary containing the created commands.
 
     Example:
         imei_list = ["123456789012345", "987654321098765"]
         profile_id = "profile_123"
-        commands = await create_commands_device_profile(imei_list, profile_id)
+        commands = create_commands_device_profile(imei_list, profile_id)
         print(commands)
     """
-    try:
-        return {
-            str(i): {
-                "command": "lwm2m.device.profile.change",
-                "params": {"thingKey": imei_number, "profileId": profile_id},
-            }
-            for i, imei_number in enumerate(imei_list, 1)
+    return dict(iter_commands_device_profile(imei_list, profile_id))
+
+
+def iter_commands_settings(
+        imei_list: Iterable[str], value_list: Iterable[str]
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to publish attribute settings changes, see create_commands_settings.
+
+    The IMEIs and values are paired up in order and iteration stops when either runs out.
+
+    :param imei_list: An iterable of IMEI numbers, consumed once.
+    :param value_list: An iterable of associated values, one per IMEI.
+    :return: An iterator of (command key, command) pairs.
+    """
+    for i, (imei_number, value) in enumerate(zip(imei_list, value_list), start=1):
+        yield str(i), {
+            "command": "attribute.publish",
+            "params": {"thingKey": imei_number, "key": "att_settings_change", "value": value},
         }
-    except Exception as e:
-        logger.error(f"Error creating device profile commands: {e}")
-        raise
 
 
-async def create_commands_settings(
-        imei_list: List[str], value_list: List[str]
+def create_commands_settings(
+        imei_list: Iterable[str], value_list: Iterable[str]
 ) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to publish attribute settings changes.
 
-    :param imei_list: A list of IMEI numbers.
-    :param value_list: A list of associated values.
+    :param imei_list: An iterable of IMEI numbers.
+    :param value_list: An iterable of associated values, one per IMEI.
     :return: A dictionary containing the created commands.
     :raises ValueError: If imei_list and value_list have different lengths.
 
     Example:
         imei_list = ["123456789012345", "987654321098765"]
         value_list = ["DM=Alarm,SI=900", "DI=86400"]
-        commands = await create_commands_settings(imei_list, value_list)
+        commands = create_commands_settings(imei_list, value_list)
         print(commands)
     """
+    # Generators and Series are read into lists once so both lengths can be compared
+    if not isinstance(imei_list, list):
+        imei_list = list(imei_list)
+    if not isinstance(value_list, list):
+        value_list = list(value_list)
+
     if len(imei_list) != len(value_list):
         logger.error("IMEI list and value list must have the same length")
         raise ValueError("IMEI list and value list must have the same length")
 
-    try:
-        return {
-            str(i): {
-                "command": "attribute.publish",
-                "params": {
-                    "thingKey": imei_number,
-                    "key": "att_settings_change",
-                    "value": value,
-                },
-            }
-            for i, (imei_number, value) in enumerate(
-                zip(imei_list, value_list), start=1
-            )
-        }
-    except Exception as e:
-        logger.error(f"Error creating settings commands: {e}")
-        raise
+    return dict(iter_commands_settings(imei_list, value_list))
+
 
+def iter_commands_thing_def(
+        imei_list: Iterable[str], thing_key: str
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to change thing definitions, see create_commands_thing_def.
+
+    :param imei_list: An iterable of IMEI numbers, consumed once.
+    :param thing_key: The new thing definition key to apply.
+    :return: An iterator of (command key, command) pairs.
+    """
+    params = {"newDefKey": thing_key, **_THING_DEF_FLAGS}
+    return _iter_device_commands("thing.def.change", imei_list, params, key_field="key")
 
-async def create_commands_thing_def(
-        imei_list: List[str], thing_key: str
+
+def create_commands_thing_def(
+        imei_list: Iterable[str], thing_key: str
 ) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to change thing definitions.
 
-    :param imei_list: A list of IMEI numbers.
+    :param imei_list: An iterable of IMEI numbers, consumed once.
     :param thing_key: The new thing definition key to apply.
     :return: A dictionary containing the created commands.
 
     Example:
         imei_list = ["123456789012345", "987654321098765"]
         thing_key = "new_def_key"
-        commands = await create_commands_thing_def(imei_list, thing_key)
+        commands = create_commands_thing_def(imei_list, thing_key)
         print(commands)
     """
-    try:
-        return {
-            str(i): {
-                "command": "thing.def.change",
-                "params": {
-                    "key": imei_number,
-                    "newDefKey": thing_key,
-                    "dropProps": False,
-                    "dropAttrs": True,
-                    "dropAlarms": True,
-                },
-            }
-            for i, imei_number in enumerate(imei_list, start=1)
-        }
-    except Exception as e:
-        logger.error(f"Error creating thing definition commands: {e}")
-        raise
+    return dict(iter_commands_thing_def(imei_list, thing_key))
+
 
+def iter_commands_undeploy(imei_list: Iterable[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to undeploy devices, see create_commands_undeploy.
 
-async def create_commands_undeploy(imei_list: List[str]) -> Dict[str, Dict[str, Any]]:
+    :param imei_list: An iterable of IMEI numbers, consumed once.
+    :return: An iterator of (command key, command) pairs.
+    """
+    return _iter_device_commands("attribute.publish", imei_list, _UNDEPLOY_PARAMS)
+
+
+def create_commands_undeploy(imei_list: Iterable[str]) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to undeploy devices by clearing their data destination.
 
-    :param imei_list: A list of IMEI numbers.
+    :param imei_list: An iterable of IMEI numbers, consumed once.
     :return: A dictionary containing the created commands.
 
     Example:
         imei_list = ["123456789012345", "987654321098765"]
-        commands = await create_commands_undeploy(imei_list)
+        commands = create_commands_undeploy(imei_list)
         print(commands)
     """
-    try:
-        return {
-            str(i): {
-                "command": "attribute.publish",
-                "params": {
-                    "thingKey": imei_number,
-                    "key": "data_destination",
-                    "value": "",
-                },
-            }
-            for i, imei_number in enumerate(imei_list, start=1)
-        }
-    except Exception as e:
-        logger.error(f"Error creating undeploy commands: {e}")
-        raise
+    return dict(iter_commands_undeploy(imei_list))
+
+
+def iter_commands_delete_tag(
+        imei_list: Iterable[str], tags_list: List[str]
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to delete tags from devices, see create_commands_delete_tag.
+
+    :param imei_list: An iterable of IMEI numbers, consumed once.
+    :param tags_list: A list of tags to delete.
+    :return: An iterator of (command key, command) pairs.
+    """
+    return _iter_device_commands("thing.tag.delete", imei_list, {"tags": list(tags_list)})
 
 
-async def create_commands_delete_tag(
-        imei_list: List[str], tags_list: List[str]
+def create_commands_delete_tag(
+        imei_list: Iterable[str], tags_list: List[str]
 ) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to delete tags from devices.
 
-    :param imei_list: A list of IMEI numbers.
+    :param imei_list: An iterable of IMEI numbers, consumed once.
     :param tags_list: A list of tags to delete.
     :return: A dictionary containing the created commands.
 
     Example:
         imei_list = ["123456789012345", "987654321098765"]
         tags_list = ["sensor", "inactive"]
-        commands = await create_commands_delete_tag(imei_list, tags_list)
+        commands = create_commands_delete_tag(imei_list, tags_list)
         print(commands)
     """
-    try:
-        return {
-            str(i): {
-                "command": "thing.tag.delete",
-                "params": {"thingKey": imei_number, "tags": tags_list},
-            }
-            for i, imei_number in enumerate(imei_list, start=1)
-        }
-    except Exception as e:
-        logger.error(f"Error creating delete tag commands: {e}")
-        raise
+    return dict(iter_commands_delete_tag(imei_list, tags_list))
+
+
+def iter_commands_delete_tags(
+        thing_keys: Union[str, Iterable[str]], tags_to_remove: List[str]
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Lazily creates commands to delete tags from one or more things, see create_commands_delete_tags.
 
+    :param thing_keys: A single thing key or an iterable of thing keys to remove tags from.
+    :param tags_to_remove: A list of tags to be removed from the specified thing(s).
+    :return: An iterator of (command key, command) pairs.
+    :raises ValueError: If tags_to_remove is empty.
+    """
+    if not tags_to_remove:
+        logger.error("tags_to_remove list cannot be empty")
+        raise ValueError("tags_to_remove list cannot be empty")
 
-async def create_commands_delete_tags(
-        thing_keys: Union[str, List[str]], tags_to_remove: List[str]
+    if isinstance(thing_keys, str):
+        thing_keys = [thing_keys]
+
+    return _iter_device_commands("thing.tag.delete", thing_keys, {"tags": list(tags_to_remove)})
+
+
+def create_commands_delete_tags(
+        thing_keys: Union[str, Iterable[str]], tags_to_remove: List[str]
 ) -> Dict[str, Dict[str, Any]]:
     """
     Creates commands to delete specified tags from one or more things.
@@ -276,30 +385,13 @@ async def create_commands_delete_tags(
     Example:
         thing_keys = ["thing_123", "thing_456"]
         tags_to_remove = ["outdated", "inactive"]
-        commands = await create_commands_delete_tags(thing_keys, tags_to_remove)
+        commands = create_commands_delete_tags(thing_keys, tags_to_remove)
         print(commands)
     """
-    if not tags_to_remove:
-        logger.error("tags_to_remove list cannot be empty")
-        raise ValueError("tags_to_remove list cannot be empty")
-
-    try:
-        if isinstance(thing_keys, str):
-            thing_keys = [thing_keys]
-
-        return {
-            str(i): {
-                "command": "thing.tag.delete",
-                "params": {"thingKey": thing_key, "tags": tags_to_remove},
-            }
-            for i, thing_key in enumerate(thing_keys, start=1)
-        }
-    except Exception as e:
-        logger.error(f"Error creating delete tag commands: {e}")
-        raise
+    return dict(iter_commands_delete_tags(thing_keys, tags_to_remove))
 
 
-async def create_command_delete_things(
+def create_command_delete_things(
         thing_keys: Optional[Union[str, List[str]]] = None,
         thing_ids: Optional[Union[str, List[str]]] = None,
         tags: Optional[List[str]] = None,
@@ -317,30 +409,24 @@ async def create_command_delete_things(
 
     Example:
         # Example 1: Delete by thing keys
-        commands = await create_command_delete_things(thing_keys=["thing_123", "thing_456"])
+        commands = create_command_delete_things(thing_keys=["thing_123", "thing_456"])
         print(commands)
 
         # Example 2: Delete by tags
-        commands = await create_command_delete_things(tags=["obsolete"])
+        commands = create_command_delete_things(tags=["obsolete"])
         print(commands)
     """
-    if sum([bool(thing_keys), bool(thing_ids), bool(tags), bool(query)]) != 1:
+    if bool(thing_keys) + bool(thing_ids) + bool(tags) + bool(query) != 1:
         logger.error("Exactly one deletion criteria must be provided")
         raise ValueError("Exactly one deletion criteria must be provided")
 
-    params: Dict[str, Any] = {}
-
     if thing_keys:
-        params["key"] = thing_keys if isinstance(thing_keys, list) else [thing_keys]
+        params: Dict[str, Any] = {"key": thing_keys if isinstance(thing_keys, list) else [thing_keys]}
     elif thing_ids:
-        params["id"] = thing_ids if isinstance(thing_ids, list) else [thing_ids]
+        params = {"id": thing_ids if isinstance(thing_ids, list) else [thing_ids]}
     elif tags:
-        params["tag"] = tags
-    elif query:
-        params["query"] = query
+        params = {"tag": tags}
+    else:
+        params = {"query": query}
 
-    try:
-        return {"command": "thing.delete", "params": params}
-    except Exception as e:
-        logger.error(f"Error creating delete things command: {e}")
-        raise
+    return {"command": "thing.delete", "params": params}
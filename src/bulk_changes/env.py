@@ -0,0 +1,17 @@
+from functools import lru_cache
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ENV_FILE: Path = Path(__file__).resolve().parents[2] / "config" / ".env"
+
+
+@lru_cache(maxsize=None)
+def load_env() -> None:
+    """
+    Loads config/.env into the environment, at most once per process.
+
+    Variables already set in the environment are never overridden, so values exported in the
+    shell take precedence over the file and any left unset are still read from it.
+    """
+    load_dotenv(ENV_FILE)
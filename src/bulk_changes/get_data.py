@@ -1,17 +1,29 @@
+import os
 import re
-from io import StringIO
-from typing import Tuple, List, Union
+from itertools import chain, compress
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-import aiofiles
 import asyncio
+import openpyxl
 import pandas as pd
 
 from src.logger.logger import Logger
 
 logger = Logger(__name__)
 
+# A cell holding exactly one IMEI, and the first IMEI found anywhere in a cell
+_IMEI_RE = re.compile(r"\d{15}")
+_IMEI_CAPTURE = re.compile(r"(\d{15})")
 
-async def read_file(file_path: str) -> pd.DataFrame:
+# Rows parsed per chunk when streaming IMEIs out of a CSV file
+CSV_CHUNK_SIZE: int = 200_000
+# Leading rows of a CSV file searched for the IMEI column before the full read
+CSV_PROBE_ROWS: int = 100
+# IMEI lists longer than this are deduplicated with pandas instead of a dict loop
+DEDUP_HASHTABLE_THRESHOLD: int = 50_000
+
+
+def read_file_sync(file_path: str) -> pd.DataFrame:
     """
     Reads an Excel or CSV file and returns the content as a pandas DataFrame.
 
@@ -21,19 +33,113 @@ async def read_file(file_path: str) -> pd.DataFrame:
     :raises FileNotFoundError: If the specified file does not exist.
     :raises pd.errors.EmptyDataError: If the file is empty.
     """
+    # Cells are read as strings so IMEIs keep their leading zeros and skip numeric inference
     if file_path.lower().endswith(".xlsx"):
-        return await asyncio.to_thread(pd.read_excel, file_path, header=None)
+        return _read_xlsx(file_path)
     elif file_path.lower().endswith(".csv"):
-        async with aiofiles.open(file_path, mode="r") as f:
-            content = await f.read()
-        return pd.read_csv(StringIO(content), header=None)
+        # mmap cannot map a zero-length file, let pandas report it as empty instead
+        memory_map = os.path.getsize(file_path) > 0
+        return pd.read_csv(
+            file_path, header=None, dtype=str, engine="c", memory_map=memory_map
+        )
     else:
         raise ValueError(
             "Unsupported file format. Only .xlsx and .csv files are supported."
         )
 
 
-async def deduplicate_imeis(imei_list: List[str], settings_list: List[str]) -> Tuple[List[str], List[str]]:
+def _read_xlsx(file_path: str) -> pd.DataFrame:
+    """
+    Reads the first worksheet of an Excel file with every filled cell as a string.
+
+    The workbook is opened read-only, so cells are streamed without loading styles or formatting.
+
+    :param file_path: The path to the input .xlsx file.
+    :return: A pandas DataFrame containing the sheet's values from its first filled row and column
+             on, empty cells as None.
+    :raises FileNotFoundError: If the specified file does not exist.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = [
+            [None if value is None else str(value) for value in row]
+            for row in workbook.worksheets[0].iter_rows(values_only=True)
+        ]
+    finally:
+        workbook.close()
+    df = pd.DataFrame(rows, dtype=object)
+
+    # Read-only sheets always start at A1, drop the empty rows above the data and columns left of it
+    filled = df.notna()
+    filled_rows = filled.any(axis=1)
+    if not filled_rows.any():
+        return pd.DataFrame()
+    df = df.iloc[filled_rows.argmax():, filled.any(axis=0).argmax():].reset_index(drop=True)
+    df.columns = range(df.shape[1])
+    return df
+
+
+def read_csv_chunks(file_path: str, usecols: Optional[List[int]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Reads a CSV file as a sequence of DataFrames of at most CSV_CHUNK_SIZE rows.
+
+    :param file_path: The path to the input .csv file.
+    :param usecols: Positions of the only columns to parse, all columns if None.
+    :return: A pandas chunk reader, usable as a context manager, yielding the file's content.
+    :raises FileNotFoundError: If the specified file does not exist.
+    :raises pd.errors.EmptyDataError: If the file is empty.
+    """
+    memory_map = os.path.getsize(file_path) > 0
+    return pd.read_csv(
+        file_path,
+        header=None,
+        dtype=str,
+        engine="c",
+        memory_map=memory_map,
+        usecols=usecols,
+        chunksize=CSV_CHUNK_SIZE,
+    )
+
+
+def _find_imei_column(df: pd.DataFrame) -> Tuple[Union[int, str, None], bool]:
+    """
+    Finds the column holding IMEI numbers, either by an 'IMEI' header cell or by its 15-digit values.
+
+    :param df: The DataFrame read from the input file, without header processing.
+    :return: A tuple of the IMEI column label (None if not found) and whether a header cell was found.
+    """
+    # Usually the IMEI header or a first IMEI sits in the first filled cell, check that cell alone
+    for col in df.columns:
+        first_index = df[col].first_valid_index()
+        if first_index is None:
+            continue
+        value = str(df[col].loc[first_index])
+        if value.lower() == "imei":
+            return col, True
+        elif _IMEI_RE.fullmatch(value):
+            return col, False
+
+    # Otherwise the header is further down or the column starts with other data, scan every cell
+    for col in df.columns:
+        values = df[col].astype(str)
+        if values.str.lower().eq("imei").any():
+            return col, True
+        elif values.str.fullmatch(_IMEI_RE, na=False).any():
+            return col, False
+    return None, False
+
+
+async def read_file(file_path: str) -> pd.DataFrame:
+    """
+    Reads an Excel or CSV file in a worker thread, see read_file_sync.
+
+    :param file_path: The path to the input file. Must be either .xlsx or .csv format.
+    :return: A pandas DataFrame containing the file's content.
+    """
+    return await asyncio.to_thread(read_file_sync, file_path)
+
+
+def _deduplicate_imeis(imei_list: List[str], settings_list: List[str]) -> Tuple[List[str], List[str]]:
     """
     Removes duplicate IMEI numbers from the provided list while maintaining correspondence with settings.
 
@@ -42,24 +148,39 @@ async def deduplicate_imeis(imei_list: List[str], settings_list: List[str]) -> T
     :return: A tuple containing two lists: unique IMEIs and their corresponding settings.
     """
     original_length = len(imei_list)
-    unique_imeis = []
-    unique_settings = []
-    seen = set()
 
-    for imei, setting in zip(imei_list, settings_list):
-        if imei not in seen:
-            seen.add(imei)
-            unique_imeis.append(imei)
-            unique_settings.append(setting)
+    if original_length > DEDUP_HASHTABLE_THRESHOLD:
+        # pandas' hashtable marks the first occurrence of each IMEI without a Python level loop
+        keep = ~pd.Series(imei_list, dtype=object).duplicated().to_numpy()
+        unique_imeis = list(compress(imei_list, keep))
+        unique_settings = list(compress(settings_list, keep))
+    else:
+        # The first setting seen for an IMEI wins, dicts keep the insertion order
+        first_settings: Dict[str, str] = {}
+        for imei, setting in zip(imei_list, settings_list):
+            first_settings.setdefault(imei, setting)
+        unique_imeis = list(first_settings)
+        unique_settings = list(first_settings.values())
 
     duplicates_removed = original_length - len(unique_imeis)
     if duplicates_removed > 0:
-        logger.info(f"Removed {duplicates_removed} duplicate IMEI numbers.")
+        logger.info("Removed %d duplicate IMEI numbers.", duplicates_removed)
 
     return unique_imeis, unique_settings
 
 
-async def read_imei_and_setting(file_path: str) -> Tuple[List[str], List[str]]:
+async def deduplicate_imeis(imei_list: List[str], settings_list: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Coroutine form of _deduplicate_imeis, removes duplicate IMEIs while keeping their settings.
+
+    :param imei_list: A list containing IMEI numbers, possibly with duplicates.
+    :param settings_list: A list containing settings corresponding to the IMEI numbers.
+    :return: A tuple containing two lists: unique IMEIs and their corresponding settings.
+    """
+    return _deduplicate_imeis(imei_list, settings_list)
+
+
+def read_imei_and_setting_sync(file_path: str) -> Tuple[List[str], List[str]]:
     """
     Reads IMEI numbers and settings from an Excel or CSV file.
 
@@ -71,26 +192,13 @@ async def read_imei_and_setting(file_path: str) -> Tuple[List[str], List[str]]:
     :raises FileNotFoundError: If the specified file does not exist.
     :raises pd.errors.EmptyDataError: If the file is empty.
     """
-    df: pd.DataFrame = await read_file(file_path)
+    df: pd.DataFrame = read_file_sync(file_path)
 
     if df.empty:
         raise ValueError("The file contains no data.")
 
-    def is_imei(value: Union[str, int]) -> bool:
-        return bool(re.match(r"^\d{15}$", str(value)))
-
     # Identify IMEI column
-    imei_col: Union[int, str, None] = None
-    header_present = False
-
-    for col in df.columns:
-        if df[col].astype(str).str.lower().eq("imei").any():
-            imei_col = col
-            header_present = True
-            break
-        elif df[col].apply(is_imei).any():
-            imei_col = col
-            break
+    imei_col, header_present = _find_imei_column(df)
 
     if imei_col is None:
         raise ValueError(
@@ -127,70 +235,116 @@ async def read_imei_and_setting(file_path: str) -> Tuple[List[str], List[str]]:
 
     # Extract IMEIs and settings
     imei_settings = df[[imei_col, setting_col]].dropna()
-    ids = imei_settings[imei_col].astype(str).str.extract(r'(\d{15})')[0].dropna().tolist()
-    settings = imei_settings[setting_col].dropna().tolist()
+    imeis = imei_settings[imei_col].astype(str).str.extract(_IMEI_CAPTURE, expand=False)
+    # Rows without a valid IMEI are dropped from both columns so each setting stays with its IMEI
+    valid = imeis.notna()
+    ids = imeis[valid].tolist()
+    settings = imei_settings.loc[valid, setting_col].tolist()
 
     # Deduplicate IMEIs while maintaining correspondence with settings
-    unique_ids, unique_settings = await deduplicate_imeis(ids, settings)
+    unique_ids, unique_settings = _deduplicate_imeis(ids, settings)
 
     return unique_ids, unique_settings
 
 
-async def read_imei_only(file_path: str) -> List[str]:
+def read_imei_only_sync(file_path: str) -> List[str]:
     """
     Reads only IMEI numbers from an Excel or CSV file.
 
+    CSV files are parsed in chunks of CSV_CHUNK_SIZE rows and, when the IMEI column shows up in
+    the first CSV_PROBE_ROWS rows, only that column is parsed.
+
     :param file_path: The path to the input file. Must be either .xlsx or .csv format.
     :return: A list containing unique IMEI numbers.
     :raises ValueError: If the file format is unsupported or if no IMEI column is found.
     :raises FileNotFoundError: If the specified file does not exist.
     :raises pd.errors.EmptyDataError: If the file is empty.
     """
-    df: pd.DataFrame = await read_file(file_path)
+    if file_path.lower().endswith(".csv"):
+        # Locate the IMEI column in the first rows, then parse only that column of the whole file
+        probe = pd.read_csv(file_path, header=None, dtype=str, engine="c", nrows=CSV_PROBE_ROWS)
+        imei_col, _ = _find_imei_column(probe)
+        usecols = None if imei_col is None else [probe.columns.get_loc(imei_col)]
+        with read_csv_chunks(file_path, usecols=usecols) as chunks:
+            return _read_imeis(chunks)
+    return _read_imeis([read_file_sync(file_path)])
+
+
+def _read_imeis(frames: Iterable[pd.DataFrame]) -> List[str]:
+    """
+    Extracts the unique IMEI numbers from the consecutive parts of one input file.
+
+    The IMEI column and any header row are located in the first part and applied to the rest.
+
+    :param frames: The DataFrames making up the file, in order, without header processing.
+    :return: A list containing unique IMEI numbers.
+    :raises ValueError: If the file is empty, has no IMEI column or no valid IMEI numbers.
+    """
+    frames = iter(frames)
+    df: pd.DataFrame = next(frames, pd.DataFrame())
 
     if df.empty:
         raise ValueError("The file contains no data.")
 
-    def is_imei(value: Union[str, int]) -> bool:
-        return bool(re.match(r"^\d{15}$", str(value)))
-
     # Identify IMEI column
-    imei_col: Union[int, str, None] = None
-    header_present = False
-
-    for col in df.columns:
-        if df[col].astype(str).str.lower().eq("imei").any():
-            imei_col = col
-            header_present = True
-            break
-        elif df[col].apply(is_imei).any():
-            imei_col = col
-            break
+    imei_col, header_present = _find_imei_column(df)
 
     if imei_col is None:
         raise ValueError(
             "No IMEI column found. Ensure the file contains a column with 15-digit numbers or a header 'IMEI'."
         )
 
+    imei_position = df.columns.get_loc(imei_col)
+
     # Handle header if present
     if header_present:
         header_row = df[df[imei_col].astype(str).str.lower() == "imei"].index[0]
-        df.columns = df.iloc[header_row]
+        header = df.iloc[header_row]
         df = df.drop(df.index[:header_row + 1])
-        df = df.reset_index(drop=True)
 
-        # Find the new column name for IMEI
-        imei_col = next((col for col in df.columns if 'imei' in str(col).lower()), None)
-        if imei_col is None:
+        # Find the IMEI column by its header name
+        imei_position = next(
+            (i for i, name in enumerate(header) if 'imei' in str(name).lower()), None
+        )
+        if imei_position is None:
             raise ValueError("IMEI column not found after processing header.")
 
-    # Extract IMEIs
-    imei_list: List[str] = df[imei_col].astype(str).str.extract(r'(\d{15})')[0].dropna().tolist()
+    # Extract IMEIs, part by part
+    imeis: pd.Series = pd.concat(
+        [
+            part.iloc[:, imei_position].astype(str).str.extract(_IMEI_CAPTURE, expand=False).dropna()
+            for part in chain((df,), frames)
+        ],
+        ignore_index=True,
+    )
 
-    if not imei_list:
+    if imeis.empty:
         raise ValueError("No valid IMEI numbers found in the file.")
 
-    # Deduplicate IMEIs
-    unique_imeis, _ = await deduplicate_imeis(imei_list, imei_list)  # Use imei_list as dummy settings
+    # Deduplicate IMEIs in pandas' hash table, keeping the first occurrence order
+    unique_imeis: List[str] = imeis.drop_duplicates().tolist()
+    duplicates_removed = len(imeis) - len(unique_imeis)
+    if duplicates_removed > 0:
+        logger.info("Removed %d duplicate IMEI numbers.", duplicates_removed)
 
     return unique_imeis
+
+
+async def read_imei_and_setting(file_path: str) -> Tuple[List[str], List[str]]:
+    """
+    Reads IMEI numbers and settings in a worker thread, see read_imei_and_setting_sync.
+
+    :param file_path: The path to the input file. Must be either .xlsx or .csv format.
+    :return: A tuple containing the unique IMEI numbers and their corresponding settings.
+    """
+    return await asyncio.to_thread(read_imei_and_setting_sync, file_path)
+
+
+async def read_imei_only(file_path: str) -> List[str]:
+    """
+    Reads only IMEI numbers in a worker thread, see read_imei_only_sync.
+
+    :param file_path: The path to the input file. Must be either .xlsx or .csv format.
+    :return: A list containing unique IMEI numbers.
+    """
+    return await asyncio.to_thread(read_imei_only_sync, file_path)
@@ -1,19 +1,40 @@
 import os
 import platform
+import shlex
 import subprocess
 import warnings
 from contextlib import contextmanager
-from typing import Optional, List, Generator
+from typing import Dict, Generator, List, Optional, Tuple
 
 from cryptography.utils import CryptographyDeprecationWarning
 
 with warnings.catch_warnings(action="ignore", category=CryptographyDeprecationWarning):
     import paramiko
+from src.bulk_changes.env import load_env
 from src.logger.logger import Logger
-from dotenv import load_dotenv
 
 logger: Logger = Logger(__name__)
-load_dotenv("config/.env")
+
+# Environment variables the undeploy process needs, read once by reload_config
+CONFIG_KEYS: Tuple[str, ...] = (
+    "DNS_SUFFIX",
+    "SSH_HOSTNAME",
+    "SSH_USERNAME",
+    "SQLITE3_DBPATH",
+    "SQLITE3_TABLE",
+)
+_config: Dict[str, str] = {}
+
+
+def reload_config() -> Dict[str, str]:
+    """
+    Load config/.env if needed and re-read the undeploy settings from the environment.
+
+    :return: The settings, keyed by environment variable name, with missing ones as empty strings.
+    """
+    load_env()
+    _config.update({key: os.getenv(key, "") for key in CONFIG_KEYS})
+    return _config
 
 
 def is_vpn_connected(dns_suffix: str) -> Optional[bool]:
@@ -32,19 +53,24 @@ def is_vpn_connected(dns_suffix: str) -> Optional[bool]:
             logger.error("Unsupported operating system.")
             return None
 
-        result: subprocess.CompletedProcess = subprocess.run(
-            command, capture_output=True, text=True, check=True
-        )
-        return any(
-            dns_suffix in line
-            for line in result.stdout.splitlines()
-            if "Connection-specific DNS Suffix" in line or "IP4.DNS" in line
-        )
+        # Read the output as it is produced and stop the command at the first matching line
+        with subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        ) as process:
+            for line in process.stdout:
+                if (
+                    "Connection-specific DNS Suffix" in line or "IP4.DNS" in line
+                ) and dns_suffix in line:
+                    process.terminate()
+                    return True
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return False
     except subprocess.CalledProcessError as e:
-        logger.error(f"Error running network command: {e}")
+        logger.error("Error running network command: %s", e)
         return None
     except Exception as e:
-        logger.error(f"An unexpected error occurred: {e}")
+        logger.error("An unexpected error occurred: %s", e)
         return None
 
 
@@ -74,16 +100,16 @@ def ssh_connection(
         else:
             ssh_client.connect(hostname, username=username)
 
-        logger.info(f"Successfully connected to SSH server at {hostname}.")
+        logger.info("Successfully connected to SSH server at %s.", hostname)
         yield ssh_client
     except paramiko.AuthenticationException:
-        logger.error(f"Authentication failed when connecting to {hostname}.")
+        logger.error("Authentication failed when connecting to %s.", hostname)
         yield None
     except paramiko.SSHException as sshException:
-        logger.error(f"Could not establish SSH connection: {sshException}")
+        logger.error("Could not establish SSH connection: %s", sshException)
         yield None
     except Exception as e:
-        logger.error(f"An error occurred while connecting to the SSH server: {e}")
+        logger.error("An error occurred while connecting to the SSH server: %s", e)
         yield None
     finally:
         if ssh_client:
@@ -105,49 +131,45 @@ def execute_sql_query(
     try:
         param_string = ','.join(f"{p}" for p in params)
         formatted_query = sql_query.format(param_string)
-        command: str = f"sqlite3 {db_path} \"{formatted_query}\""
+        # The query is sent on stdin, so its size is not limited by the remote command line length
+        command: str = f"sqlite3 -bail {shlex.quote(db_path)}"
         stdin, stdout, stderr = ssh_client.exec_command(command)
+        stdin.write(formatted_query)
+        stdin.channel.shutdown_write()
         result: str = stdout.read().decode()
         error: str = stderr.read().decode()
         if error:
-            logger.error(f"Error executing SQL query: {error}")
+            logger.error("Error executing SQL query: %s", error)
             return None
         return result
     except Exception as e:
-        logger.error(f"An error occurred while executing SQL query: {e}")
+        logger.error("An error occurred while executing SQL query: %s", e)
         return None
 
 
-def construct_select_query(table_name: str) -> str:
+def sql_string_list(values: List[str]) -> str:
     """
-    Construct a parameterized SELECT query.
+    Render values as a comma separated list of SQL string literals.
 
-    :param table_name: The name of the table to query.
-    :return: A parameterized SELECT query string.
+    :param values: The values to quote.
+    :return: The quoted values, e.g. 'a','b', with embedded quotes doubled.
     """
-    return f"SELECT * FROM {table_name} WHERE imei IN ({{}});"
+    return ",".join("'" + value.replace("'", "''") + "'" for value in values)
 
 
-def construct_delete_query(table_name: str) -> str:
+def construct_undeploy_script(table_name: str) -> str:
     """
-    Construct a parameterized DELETE query.
+    Construct a parameterized script that counts and deletes the matching devices in one transaction.
 
     :param table_name: The name of the table to delete from.
-    :return: A parameterized DELETE query string.
+    :return: A parameterized SQL script whose only output is the number of matching devices.
     """
-    return f"DELETE FROM {table_name} WHERE imei IN ({{}});"
-
-
-def count_results(result: Optional[str]) -> int:
-    """
-    Count the number of results returned by the SQL query.
-
-    :param result: The raw output from the SQL query execution.
-    :return: The number of records found.
-    """
-    if result is None:
-        return 0
-    return len(result.strip().split("\n")) if result.strip() else 0
+    return (
+        "BEGIN;\n"
+        f"SELECT COUNT(*) FROM {table_name} WHERE imei IN ({{0}});\n"
+        f"DELETE FROM {table_name} WHERE imei IN ({{0}});\n"
+        "COMMIT;\n"
+    )
 
 
 def undeploy_process(imei_list: List[str]) -> None:
@@ -157,11 +179,17 @@ def undeploy_process(imei_list: List[str]) -> None:
     :param imei_list: List of IMEI numbers to check and delete.
     :return: None
     """
-    dns_suffix: str = os.getenv("DNS_SUFFIX", "")
-    ssh_hostname: str = os.getenv("SSH_HOSTNAME", "")
-    ssh_username: str = os.getenv("SSH_USERNAME", "")
-    db_path: str = os.getenv("SQLITE3_DBPATH", "")
-    table_name: str = os.getenv("SQLITE3_TABLE", "")
+    # An empty list would render as "IN ()", so there is nothing to look up or delete
+    if not imei_list:
+        logger.info("No IMEI numbers given. Nothing to undeploy.")
+        return
+
+    config: Dict[str, str] = _config or reload_config()
+    dns_suffix: str = config["DNS_SUFFIX"]
+    ssh_hostname: str = config["SSH_HOSTNAME"]
+    ssh_username: str = config["SSH_USERNAME"]
+    db_path: str = config["SQLITE3_DBPATH"]
+    table_name: str = config["SQLITE3_TABLE"]
 
     vpn_connected: Optional[bool] = is_vpn_connected(dns_suffix)
 
@@ -171,38 +199,26 @@ def undeploy_process(imei_list: List[str]) -> None:
                 hostname=ssh_hostname, username=ssh_username, private_key_path=None
         ) as ssh_client:
             if ssh_client:
-                select_query: str = construct_select_query(table_name)
-                select_result: Optional[str] = execute_sql_query(
+                # Counting and deleting share one sqlite3 run, and the delete only commits if both succeed
+                undeploy_script: str = construct_undeploy_script(table_name)
+                undeploy_result: Optional[str] = execute_sql_query(
                     ssh_client,
                     db_path,
-                    select_query,
-                    (",".join(f"'{imei}'" for imei in imei_list),),
+                    undeploy_script,
+                    (sql_string_list(imei_list),),
                 )
 
-                if select_result is not None:
-                    count: int = count_results(select_result)
+                if undeploy_result is not None:
+                    count: int = int(undeploy_result.strip() or 0)
                     logger.info(
-                        f"Number of devices found: {count} out of {len(imei_list)}"
+                        "Number of devices found: %d out of %d", count, len(imei_list)
                     )
-
                     if count > 0:
-                        delete_query: str = construct_delete_query(table_name)
-                        delete_result: Optional[str] = execute_sql_query(
-                            ssh_client,
-                            db_path,
-                            delete_query,
-                            (",".join(f"'{imei}'" for imei in imei_list),),
-                        )
-                        if delete_result is not None:
-                            logger.info(
-                                "Devices with the specified IMEIs have been deleted."
-                            )
-                        else:
-                            logger.error("Failed to delete devices.")
+                        logger.info("Devices with the specified IMEIs have been deleted.")
                     else:
                         logger.info("No devices found to delete.")
                 else:
-                    logger.error("Failed to execute select query.")
+                    logger.error("Failed to delete devices.")
             else:
                 logger.error("Failed to establish SSH connection.")
     elif vpn_connected is False:
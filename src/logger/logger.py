@@ -1,7 +1,7 @@
 import logging
 import time
 from functools import wraps
-from typing import Any, Callable, Dict, Optional, TypeVar
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
 
 T = TypeVar("T")
 
@@ -38,6 +38,14 @@ class ColorFormatter(logging.Formatter):
         """
         super().__init__(fmt, datefmt, style)
         self.use_color: bool = use_color
+        # (color_on, color_off) per level, without colors every level maps to empty strings
+        self._colors: Dict[int, Tuple[str, str]] = {
+            level: (code, self.RESET_CODE) if use_color else ("", "")
+            for level, code in self.COLOR_CODES.items()
+        }
+        self._default_colors: Tuple[str, str] = (
+            (self.RESET_CODE, self.RESET_CODE) if use_color else ("", "")
+        )
 
     def format(self, record: logging.LogRecord) -> str:
         """
@@ -49,11 +57,7 @@ class ColorFormatter(logging.Formatter):
         Returns:
             str: The formatted log record.
         """
-        if self.use_color:
-            record.color_on = self.COLOR_CODES.get(record.levelno, self.RESET_CODE)
-            record.color_off = self.RESET_CODE
-        else:
-            record.color_on = record.color_off = ""
+        record.color_on, record.color_off = self._colors.get(record.levelno, self._default_colors)
         return super().format(record)
 
 
@@ -71,89 +75,105 @@ class Logger:
         if not self.logger.handlers:
             self.logger.setLevel(log_level)
 
+            stream_handler = logging.StreamHandler()
+
+            # Only color the output when it goes to a terminal, not to a file or pipe
+            stream = stream_handler.stream
             formatter = ColorFormatter(
-                "%(color_on)s[%(asctime)s] %(message)s%(color_off)s"
+                "%(color_on)s[%(asctime)s] %(message)s%(color_off)s",
+                use_color=hasattr(stream, "isatty") and stream.isatty(),
             )
             formatter.converter = time.gmtime  # Use GMT for timestamps
 
-            stream_handler = logging.StreamHandler()
             stream_handler.setFormatter(formatter)
 
             self.logger.addHandler(stream_handler)
             self.logger.propagate = False  # Avoid duplicate logs
 
-    def _log_with_context(self, level: int, message: str, **context: Any) -> None:
+    def _log_with_context(self, level: int, message: str, *args: Any, **context: Any) -> None:
         """
         Log a message with context at the specified level.
 
         Args:
             level (int): The logging level.
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting, only if it is emitted.
             **context: Additional context to include in the log message.
         """
+        if not self.logger.isEnabledFor(level):
+            return
         context_str = " ".join(f"{k}={v}" for k, v in context.items())
+        if context_str and args:
+            # The context is appended to the format string, keep its values literal
+            context_str = context_str.replace("%", "%%")
         full_message = f"{message} [{context_str}]" if context_str else message
-        self.logger.log(level, full_message)
+        self.logger.log(level, full_message, *args)
 
-    def info(self, message: str, **context: Any) -> None:
+    def info(self, message: str, *args: Any, **context: Any) -> None:
         """
         Log an informational message.
 
         Args:
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting.
             **context: Additional context to include in the log message.
         """
-        self._log_with_context(logging.INFO, message, **context)
+        self._log_with_context(logging.INFO, message, *args, **context)
 
-    def error(self, message: str, **context: Any) -> None:
+    def error(self, message: str, *args: Any, **context: Any) -> None:
         """
         Log an error message.
 
         Args:
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting.
             **context: Additional context to include in the log message.
         """
-        self._log_with_context(logging.ERROR, message, **context)
+        self._log_with_context(logging.ERROR, message, *args, **context)
 
-    def debug(self, message: str, **context: Any) -> None:
+    def debug(self, message: str, *args: Any, **context: Any) -> None:
         """
         Log a debug message.
 
         Args:
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting.
             **context: Additional context to include in the log message.
         """
-        self._log_with_context(logging.DEBUG, message, **context)
+        self._log_with_context(logging.DEBUG, message, *args, **context)
 
-    def warning(self, message: str, **context: Any) -> None:
+    def warning(self, message: str, *args: Any, **context: Any) -> None:
         """
         Log a warning message.
 
         Args:
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting.
             **context: Additional context to include in the log message.
         """
-        self._log_with_context(logging.WARNING, message, **context)
+        self._log_with_context(logging.WARNING, message, *args, **context)
 
-    def critical(self, message: str, **context: Any) -> None:
+    def critical(self, message: str, *args: Any, **context: Any) -> None:
         """
         Log a critical message.
 
         Args:
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting.
             **context: Additional context to include in the log message.
         """
-        self._log_with_context(logging.CRITICAL, message, **context)
+        self._log_with_context(logging.CRITICAL, message, *args, **context)
 
-    def exception(self, message: str, **context: Any) -> None:
+    def exception(self, message: str, *args: Any, **context: Any) -> None:
         """
         Log an exception message.
 
         Args:
             message (str): The message to log.
+            *args: Values merged into the message with %-formatting.
             **context: Additional context to include in the log message.
         """
-        self.logger.exception(message, extra=context)
+        self.logger.exception(message, *args, extra=context)
 
     @staticmethod
     def log_execution(
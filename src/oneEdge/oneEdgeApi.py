@@ -4,10 +4,15 @@ oneEdge API Module
 This module provides a class to interact with the oneEdge API.
 """
 import asyncio
+import gzip
+import random
+import time
 from enum import Enum
-from typing import Any, Dict, List, Optional
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import aiohttp
+import orjson
 from cachetools import TTLCache
 
 from src.logger.logger import Logger
@@ -36,34 +41,120 @@ class OneEdgeApiError(Exception):
         super().__init__(message)
 
 
+# Authentication state implied by the last API error code when there is no session
+_ERROR_AUTH_STATES: Dict[Optional[int], AuthState] = {
+    -90041: AuthState.WAITING_FOR_MFA,
+    -90000: AuthState.NOT_AUTHENTICATED,
+}
+
+# Session ids the API or an old session cache may return in place of a real one
+_INVALID_SESSION_IDS = frozenset({"None", "null"})
+
+# Auth envelope sent while there is no session, shared and never modified
+_NO_AUTH: Dict[str, Optional[str]] = {'sessionId': None}
+
+
+class TokenBucket:
+    """Limits the request rate shared by all callers, allowing short bursts"""
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        Initializes a new instance of the class.
+
+        Args:
+            rate (float): The number of tokens added per second.
+            capacity (int): The most tokens that can be saved up for a burst.
+        """
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self._tokens: float = float(capacity)
+        self._updated: float = time.monotonic()
+        self._lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Waits until a token is available and takes it.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
 class OneEdgeApi:
     MAX_RETRIES: int = 3
     RETRY_DELAY: int = 5
+    MAX_RETRY_DELAY: int = 30
+    # Attempts per request, and the first backoff delay between them
+    REQUEST_RETRIES: int = 5
+    REQUEST_RETRY_DELAY: float = 0.5
     ITERATION_LIMIT: int = 100
-
-    def __init__(self, endpoint_url: str):
+    CONNECTION_LIMIT: int = 32
+    KEEPALIVE_TIMEOUT: int = 60
+    DNS_CACHE_TTL: int = 300
+    REQUEST_TIMEOUT: int = 60
+    CONNECT_TIMEOUT: int = 10
+    # Seconds a session id is used before it is treated as expired
+    SESSION_TTL: int = 28800
+    # Seconds a successful session.info check is trusted before asking the API again
+    VERIFY_CACHE_TTL: int = 30
+    # Requests per second allowed across all callers, and how many may be sent in a burst
+    RATE_LIMIT: float = 10.0
+    RATE_BURST: int = 16
+    RATE_LIMITED_ERROR: int = -90005
+    SESSION_HEADERS: Dict[str, str] = {'User-Agent': 'bulk_changes/1.0'}
+    JSON_HEADERS: Dict[str, str] = {'Content-Type': 'application/json'}
+    GZIP_HEADERS: Dict[str, str] = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+
+    def __init__(
+            self,
+            endpoint_url: str,
+            *,
+            session: Optional[aiohttp.ClientSession] = None,
+            connector: Optional[aiohttp.BaseConnector] = None,
+            gzip_min_size: Optional[int] = None
+    ):
         """
         Initializes a new instance of the OneEdgeApi class.
 
         Args:
             endpoint_url (str): The URL of the oneEdge API endpoint.
+            session (Optional[aiohttp.ClientSession]): An HTTP session shared with other clients.
+                The caller keeps ownership and closes it.
+            connector (Optional[aiohttp.BaseConnector]): A connection pool shared with other clients,
+                used when no session is given. The caller keeps ownership and closes it; by default
+                a private pool is created.
+            gzip_min_size (Optional[int]): Request bodies of at least this many bytes are sent
+                gzip-compressed. Compression is off by default, as the endpoint may not accept it.
         """
         self.endpoint_url: str = endpoint_url
-        self._session_cache: TTLCache = TTLCache(maxsize=1, ttl=28800)
+        self._auth_envelope: Dict[str, Optional[str]] = _NO_AUTH
+        self._session_expiry: float = 0.0
+        self._verified_cache: TTLCache = TTLCache(maxsize=1, ttl=self.VERIFY_CACHE_TTL)
         self._last_error: Optional[int] = None
         self._auth_state: AuthState = AuthState.NOT_AUTHENTICATED
         self.username: str = None
+        self._session: Optional[aiohttp.ClientSession] = session
+        self._owns_session: bool = session is None
+        self._connector: Optional[aiohttp.BaseConnector] = connector
+        self._gzip_min_size: Optional[int] = gzip_min_size
+        self._rate_limiter: TokenBucket = TokenBucket(self.RATE_LIMIT, self.RATE_BURST)
+        self._auth_lock: asyncio.Lock = asyncio.Lock()
 
     @property
     def session_id(self) -> Optional[str]:
         """Gets the session id"""
-        return self._session_cache.get('session_id')
+        return self._current_auth()['sessionId']
 
     @session_id.setter
     def session_id(self, value: Optional[str]) -> None:
         """Sets the session id"""
-        self._session_cache['session_id'] = value
-        self._auth_state = self._calculate_auth_state()
+        self._set_auth(value)
 
     @property
     def last_error(self) -> Optional[int]:
@@ -73,12 +164,18 @@ class OneEdgeApi:
     @last_error.setter
     def last_error(self, value: Optional[int]) -> None:
         """Sets the last error"""
+        # Most responses leave the error unchanged, so the state only needs recalculating on a change
+        if value == self._last_error:
+            return
         self._last_error = value
         self._auth_state = self._calculate_auth_state()
 
     @property
     def auth_state(self) -> AuthState:
         """Gets the authentication state"""
+        # A session past SESSION_TTL no longer counts, whatever state was set while it was valid
+        if self._auth_state == AuthState.AUTHENTICATED and self.session_id is None:
+            return self._calculate_auth_state()
         return self._auth_state
 
     @auth_state.setter
@@ -87,6 +184,90 @@ class OneEdgeApi:
         if state != self._auth_state:
             self._auth_state = state
 
+    def _set_auth(self, session_id: Optional[str], state: Optional[AuthState] = None) -> None:
+        """
+        Sets the session id and the authentication state in one step.
+
+        Args:
+            session_id (Optional[str]): The session id, or None to drop the session.
+            state (Optional[AuthState]): The state to set, calculated from the session and
+                last error when omitted.
+        """
+        # The request envelope is built once per session and expires with it
+        self._auth_envelope = {'sessionId': session_id}
+        self._session_expiry = time.monotonic() + self.SESSION_TTL
+        self._auth_state = state or self._calculate_auth_state()
+
+    def _current_auth(self) -> Dict[str, Optional[str]]:
+        """
+        Gets the auth envelope to send with a request.
+
+        Returns:
+            Dict[str, Optional[str]]: The envelope of the current session, or one without a
+                session id once SESSION_TTL has passed.
+        """
+        if time.monotonic() < self._session_expiry:
+            return self._auth_envelope
+        return _NO_AUTH
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Gets the HTTP session shared by all requests, creating it on first use.
+
+        Returns:
+            aiohttp.ClientSession: The open client session.
+        """
+        if self._owns_session and (self._session is None or self._session.closed):
+            connector = self._connector or aiohttp.TCPConnector(
+                limit=self.CONNECTION_LIMIT,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=self.DNS_CACHE_TTL
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                connector_owner=self._connector is None,
+                headers=self.SESSION_HEADERS,
+                # The API authenticates through the payload, so response cookies are never needed
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT, connect=self.CONNECT_TIMEOUT)
+            )
+        return self._session
+
+    async def prewarm(self) -> None:
+        """
+        Opens a pooled connection to the API host so the first command skips the DNS and TLS setup.
+
+        Failures are only logged, the next real request will connect as usual.
+        """
+        try:
+            session = await self._get_session()
+            async with session.head(self.endpoint_url) as response:
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug("Connection prewarm failed", error=str(e))
+
+    async def aclose(self) -> None:
+        """
+        Closes the HTTP session and releases its pooled connections.
+
+        A session passed in by the caller is left open.
+        """
+        if not self._owns_session:
+            return
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # Let the connector's transports finish closing before the loop shuts down
+            await asyncio.sleep(0)
+        self._session = None
+
+    async def __aenter__(self) -> "OneEdgeApi":
+        """Binds the HTTP session to an ``async with`` block."""
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        """Closes the HTTP session when the ``async with`` block exits."""
+        await self.aclose()
+
     def _calculate_auth_state(self) -> AuthState:
         """
         Calculate the authentication state based on the current session ID
@@ -97,11 +278,7 @@ class OneEdgeApi:
         """
         if self.session_id is not None:
             return AuthState.AUTHENTICATED
-        if self.last_error == -90041:
-            return AuthState.WAITING_FOR_MFA
-        if self.last_error == -90000:
-            return AuthState.NOT_AUTHENTICATED
-        return AuthState.NOT_AUTHENTICATED
+        return _ERROR_AUTH_STATES.get(self._last_error, AuthState.NOT_AUTHENTICATED)
 
     async def run_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -117,7 +294,9 @@ class OneEdgeApi:
             OneEdgeApiError: If an error occurs while making the request.
         """
         try:
-            result = await self.run_commands({'1': command})
+            # Built directly rather than through run_commands, saving the one entry cmds dict
+            payload: Dict[str, Any] = {'auth': self._current_auth(), '1': command}
+            result = await self._send_payload(payload, ('1',))
             return result.get('1', result)
         except OneEdgeApiError as e:
             logger.exception("An error occurred while making the request", error=str(e))
@@ -136,56 +315,122 @@ class OneEdgeApi:
         Raises:
             OneEdgeApiError: If failed to receive a response from the API.
         """
-        payload: Dict[str, Any] = {'auth': {'sessionId': self.session_id}}
-        payload.update(cmds)
+        payload: Dict[str, Any] = {'auth': self._current_auth(), **cmds}
+        return await self._send_payload(payload, cmds)
+
+    async def _send_payload(self, payload: Dict[str, Any], cmd_keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Post a request payload, retrying requests the API refused or never received.
+
+        The commands may change devices, so a request that may have reached the API, such as one
+        that timed out waiting for the response, is never sent again.
+
+        Args:
+            payload (Dict[str, Any]): The auth envelope together with the commands to send.
+            cmd_keys (Iterable[str]): The keys of the commands in the payload.
+
+        Returns:
+            Dict[str, Any]: The results of the commands.
+
+        Raises:
+            OneEdgeApiError: If failed to receive a response from the API.
+        """
+        body, headers = self._encode_payload(payload)
 
         response_data: Optional[Dict[str, Any]] = None
-        for retry_count in range(self.MAX_RETRIES):
+        for retry_count in range(self.REQUEST_RETRIES):
+            # Only the last attempt's answer counts, an earlier refusal says nothing about it
+            response_data = None
+            retry_after: Optional[str] = None
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(self.endpoint_url, json=payload) as response:
-                        response_data = await response.json()
-                        break
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                logger.error("An error occurred while making the request",
-                             error=str(e), retry_count=retry_count)
-                if retry_count < self.MAX_RETRIES - 1:
-                    await asyncio.sleep(self.RETRY_DELAY)
-                else:
-                    logger.error("Failed to make the request after multiple retries",
-                                 max_retries=self.MAX_RETRIES)
+                session = await self._get_session()
+                await self._rate_limiter.acquire()
+                async with session.post(self.endpoint_url, data=body, headers=headers) as response:
+                    retry_after = response.headers.get('Retry-After')
+                    # Rate limits and announced outages are refused before any command runs
+                    refused = response.status == 429 or (response.status == 503 and retry_after is not None)
+                    if not refused:
+                        decoded = orjson.loads(await response.read())
+                        # Valid JSON that is not an object is as unusable as an undecodable body
+                        if isinstance(decoded, dict):
+                            response_data = decoded
+                            refused = self.RATE_LIMITED_ERROR in (decoded.get('errorCodes') or ())
+                if not refused:
+                    break
+                logger.warning("Request refused by the API",
+                               status=response.status, retry_count=retry_count)
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                # No connection was made, so the request never reached the API
+                logger.error("Could not connect to the API", error=str(e), retry_count=retry_count)
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+                logger.error("An error occurred while making the request", error=str(e))
+                break
+            if retry_count < self.REQUEST_RETRIES - 1:
+                await asyncio.sleep(self._retry_after_delay(retry_after, retry_count))
+            else:
+                logger.error("Failed to make the request after multiple retries",
+                             max_retries=self.REQUEST_RETRIES)
 
         if response_data is None:
             logger.error("Failed to receive a response")
             raise OneEdgeApiError("Failed to receive a response from the API.")
 
-        return self._process_response(response_data, cmds)
+        return self._process_response(response_data, cmd_keys)
+
+    def _retry_after_delay(self, retry_after: Optional[str], attempt: int) -> float:
+        """
+        Calculates how long to wait before retrying a failed request.
+
+        Args:
+            retry_after (Optional[str]): The Retry-After header of the response, if any.
+            attempt (int): The zero-based number of the attempt that failed.
+
+        Returns:
+            float: The delay in seconds asked for by the API, or the backoff delay otherwise.
+        """
+        try:
+            return min(self.MAX_RETRY_DELAY, max(0.0, float(retry_after)))
+        except (TypeError, ValueError):
+            return self._backoff_delay(attempt, self.REQUEST_RETRY_DELAY)
+
+    def _encode_payload(self, payload: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+        """
+        Serializes a request payload, compressing it when it reaches the gzip_min_size threshold.
+
+        Args:
+            payload (Dict[str, Any]): The request payload.
+
+        Returns:
+            Tuple[bytes, Dict[str, str]]: The request body and the headers to send with it.
+        """
+        body = orjson.dumps(payload)
+        if self._gzip_min_size is not None and len(body) >= self._gzip_min_size:
+            return gzip.compress(body, compresslevel=1), self.GZIP_HEADERS
+        return body, self.JSON_HEADERS
 
-    def _process_response(self, response_data: Dict[str, Any], cmds: Dict[str, Any]) -> Dict[str, Any]:
+    def _process_response(self, response_data: Dict[str, Any], cmds: Iterable[str]) -> Dict[str, Any]:
         """
         Process the API response.
 
         Args:
             response_data (Dict[str, Any]): The response data from the API.
-            cmds (Dict[str, Any]): The original commands sent to the API.
+            cmds (Iterable[str]): The keys of the original commands sent to the API.
 
         Returns:
             Dict[str, Any]: The processed results.
         """
-        results: Dict[str, Any] = response_data if response_data else {}
+        results: Dict[str, Any] = response_data or {}
 
-        if 'success' in response_data and not response_data['success']:
-            for cmd_key in cmds:
-                results[cmd_key] = {'success': False, 'errorCodes': response_data['errorCodes']}
-        else:
+        if results.get('success', True):
+            error_codes: List[int] = []
             results['success'] = True
-            results['errorCodes'] = []
-
-        if results['errorCodes']:
-            self.last_error = results['errorCodes'][0]
         else:
-            self.last_error = None
+            # The whole request failed, so every command gets the request's error codes
+            error_codes = results.get('errorCodes') or []
+            results.update({cmd_key: {'success': False, 'errorCodes': error_codes} for cmd_key in cmds})
+        results['errorCodes'] = error_codes
 
+        self.last_error = error_codes[0] if error_codes else None
         return results
 
     async def run_iterated_command(self, cmd: Dict[str, Any]) -> List[Any]:
@@ -198,27 +443,29 @@ class OneEdgeApi:
         Returns:
             List[Any]: The aggregated results from all iterations.
         """
-        cmd['params'].update({
+        params: Dict[str, Any] = cmd['params']
+        params.update({
             'iterator': 'new',
             'useSearch': True,
             'limit': 2000,
             'showCount': False
         })
 
-        results: List[Any] = []
+        # Pages are kept as they arrive and joined once at the end
+        pages: List[List[Any]] = []
+        run_command = self.run_command
         for iteration in range(self.ITERATION_LIMIT):
-            result = await self.run_command(cmd)
+            result = await run_command(cmd)
             if not result['success']:
                 logger.warning("Iterated command unsuccessful", iteration=iteration)
-                return results
-
-            results.extend(result['params']['result'])
-            cmd['params']['iterator'] = result['params']['iterator']
+                return list(chain.from_iterable(pages))
 
-            await asyncio.sleep(0.5)
+            result_params = result['params']
+            pages.append(result_params['result'])
+            params['iterator'] = result_params['iterator']
 
         logger.warning("Reached maximum iteration limit", limit=self.ITERATION_LIMIT)
-        return results
+        return list(chain.from_iterable(pages))
 
     async def authenticate(self, username: str, password: str) -> bool:
         """
@@ -246,8 +493,7 @@ class OneEdgeApi:
             auth_response = result.get('auth', {})
 
             if auth_response.get('success'):
-                self.session_id = auth_response['params'].get('sessionId')
-                self.auth_state = AuthState.AUTHENTICATED
+                self._set_auth(auth_response['params'].get('sessionId'), AuthState.AUTHENTICATED)
                 logger.info("Authentication successful", username=username)
                 return True
             else:
@@ -262,7 +508,7 @@ class OneEdgeApi:
 
     async def close_session(self) -> Optional[Dict[str, Any]]:
         """
-        Close the session with the API.
+        Close the session with the API and release its HTTP connections.
 
         Returns:
             Optional[Dict[str, Any]]: The response from the API, or None if an error occurred.
@@ -287,6 +533,8 @@ class OneEdgeApi:
         except OneEdgeApiError as e:
             logger.exception("An error occurred while closing the session", error=str(e))
             raise
+        finally:
+            await self.aclose()
 
     async def verify_auth_state(self) -> None:
         """
@@ -296,18 +544,24 @@ class OneEdgeApi:
             OneEdgeApiError: If an error occurs while verifying the authentication state.
         """
         try:
-            if not self.session_id or self.session_id in ["None", "null"]:
-                self.session_id = None
-                self.auth_state = AuthState.NOT_AUTHENTICATED
+            session_id = self.session_id
+            if not session_id or session_id in _INVALID_SESSION_IDS:
+                self._set_auth(None, AuthState.NOT_AUTHENTICATED)
                 logger.info("Auth state set to NOT_AUTHENTICATED due to invalid session ID")
                 return
 
+            # The same session was confirmed moments ago, skip the round trip
+            if self._verified_cache.get('session_id') == session_id:
+                self.auth_state = AuthState.AUTHENTICATED
+                return
+
             request = await self.run_command({"command": "session.info"})
             if request["success"]:
                 self.auth_state = AuthState.AUTHENTICATED
+                self._verified_cache['session_id'] = session_id
             else:
-                self.session_id = None
-                self.auth_state = AuthState.NOT_AUTHENTICATED
+                self._verified_cache.clear()
+                self._set_auth(None, AuthState.NOT_AUTHENTICATED)
                 logger.warning("Auth state set to NOT_AUTHENTICATED after failed verification")
         except OneEdgeApiError as e:
             logger.exception("An error occurred while verifying the authentication state", error=str(e))
@@ -324,19 +578,40 @@ class OneEdgeApi:
         Returns:
             bool: True if authentication was successful, False otherwise.
         """
-        self.username = username
-        for attempt in range(self.MAX_RETRIES):
-            if self.auth_state == AuthState.AUTHENTICATED or await self._attempt_authentication(username, password):
-                if await self._verify_auth_state():
-                    return True
-                else:
-                    logger.error("Failed to verify authentication state", username=username)
-                    return False
-            else:
-                logger.warning("Authentication attempt failed, retrying", attempt=attempt + 1)
-                await asyncio.sleep(self.RETRY_DELAY)
-        logger.error("Failed to authenticate with the oneEdge API after multiple attempts", username=username)
-        return False
+        # Concurrent callers wait here, the first one logs in and the rest reuse its session
+        async with self._auth_lock:
+            self.username = username
+            for attempt in range(self.MAX_RETRIES):
+                self.last_error = None
+                if self.auth_state == AuthState.AUTHENTICATED or await self._attempt_authentication(username, password):
+                    if await self._verify_auth_state():
+                        return True
+                    else:
+                        logger.error("Failed to verify authentication state", username=username)
+                        return False
+                # An error code from the API means the credentials were rejected, retrying will not help
+                if self.last_error is not None and self.last_error != -90000:
+                    break
+                if attempt + 1 < self.MAX_RETRIES:
+                    logger.warning("Authentication attempt failed, retrying", attempt=attempt + 1)
+                    await asyncio.sleep(self._backoff_delay(attempt))
+            logger.error("Failed to authenticate with the oneEdge API after multiple attempts", username=username)
+            return False
+
+    def _backoff_delay(self, attempt: int, base: Optional[float] = None) -> float:
+        """
+        Calculates how long to wait before the next retry.
+
+        Args:
+            attempt (int): The zero-based number of the attempt that just failed.
+            base (Optional[float]): The delay after the first attempt, RETRY_DELAY by default.
+
+        Returns:
+            float: The delay in seconds, doubling per attempt with a little random jitter.
+        """
+        if base is None:
+            base = self.RETRY_DELAY
+        return min(self.MAX_RETRY_DELAY, base * 2 ** attempt) + random.uniform(0, 0.5)
 
     async def _verify_auth_state(self) -> bool:
         """
@@ -381,7 +656,8 @@ class OneEdgeApi:
             bool: True if the response was handled successfully, False otherwise.
         """
         if self.auth_state == AuthState.WAITING_FOR_MFA:
-            mfa_code: str = input("Enter your MFA code: ")
+            # Read from a worker thread so the event loop keeps running while waiting for the code
+            mfa_code: str = await asyncio.to_thread(input, "Enter your MFA code: ")
             try:
                 return await self.authenticate(self.username, mfa_code)
             except OneEdgeApiError as e:
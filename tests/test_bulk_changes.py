@@ -1,75 +1,138 @@
-import os
+import aiohttp
+import asyncio
+import gzip
+import openpyxl
+import orjson
 import pandas as pd
 import pytest
-from typing import List
+import socket
+from aiohttp import web
+from cachetools import TTLCache
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List, Optional, Tuple, Union
 
+import bulk_changes
+from bulk_changes import process_commands
+
+from src.bulk_changes.create_commands import (
+    LIST_PAGE_SIZE,
+    clear_lookup_cache,
+    create_commands_delete_tags,
+    create_commands_tags,
+    get_profile_id,
+)
 from src.bulk_changes.get_data import (
     read_imei_and_setting,
     read_imei_only,
     deduplicate_imeis,
 )
+from src.bulk_changes import get_data, undeploy_process
+from src.bulk_changes.undeploy_process import construct_undeploy_script, sql_string_list
+from src.oneEdge import oneEdgeApi
+from src.oneEdge.oneEdgeApi import AuthState, OneEdgeApi, OneEdgeApiError
 
 
-def create_temp_csv(content: str, filename: str) -> None:
+def create_temp_csv(tmp_path: Path, content: str, filename: str) -> str:
     """
     Helper function to create a temporary CSV file with the given content.
 
     Args:
+        tmp_path (Path): The per-test temporary directory to create the file in.
         content (str): The content to write into the file.
         filename (str): The name of the file to create.
+
+    Returns:
+        str: The path of the created file.
     """
-    with open(filename, "w") as f:
-        f.write(content)
+    path = tmp_path / filename
+    path.write_text(content)
+    return str(path)
 
 
-@pytest.fixture(autouse=True)
-def cleanup() -> None:
+def create_temp_xlsx(
+        tmp_path: Path, rows: List[list], filename: str, first_row: int = 1, first_column: int = 1
+) -> str:
     """
-    Fixture to clean up temporary files after each test.
+    Helper function to create a temporary Excel file with the given rows.
+
+    Args:
+        tmp_path (Path): The per-test temporary directory to create the file in.
+        rows (List[list]): The cell values, row by row.
+        filename (str): The name of the file to create.
+        first_row (int): The sheet row the first row is written to.
+        first_column (int): The sheet column the first value of each row is written to.
+
+    Returns:
+        str: The path of the created file.
     """
-    yield
-    for file in ["test_imei.csv", "test_imei_settings.csv"]:
-        if os.path.exists(file):
-            os.remove(file)
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row_offset, row in enumerate(rows):
+        for column_offset, value in enumerate(row):
+            sheet.cell(row=first_row + row_offset, column=first_column + column_offset, value=value)
+    path = tmp_path / filename
+    workbook.save(path)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def large_imei_content() -> str:
+    """
+    Fixture building the content of a CSV file with 100,000 IMEIs once per module.
+    """
+    return "IMEI\n" + "\n".join(f"{i:015d}" for i in range(100000))
 
 
 @pytest.mark.asyncio
-async def test_read_imei_only_no_header() -> None:
+async def test_read_imei_only_no_header(tmp_path: Path) -> None:
     """
     Test reading IMEIs from a file without a header.
     """
     content = "123456789012345\n987654321098765\n123456789012345"
-    create_temp_csv(content, "test_imei.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
 
-    result: List[str] = await read_imei_only("test_imei.csv")
+    result: List[str] = await read_imei_only(path)
     assert len(result) == 2
     assert result == ["123456789012345", "987654321098765"]
 
 
 @pytest.mark.asyncio
-async def test_read_imei_only_with_header() -> None:
+async def test_read_imei_only_with_header(tmp_path: Path) -> None:
     """
     Test reading IMEIs from a file with a header.
     """
     content = "IMEI\n123456789012345\n987654321098765"
-    create_temp_csv(content, "test_imei.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
 
-    result: List[str] = await read_imei_only("test_imei.csv")
+    result: List[str] = await read_imei_only(path)
     assert len(result) == 2
     assert result == ["123456789012345", "987654321098765"]
 
 
 @pytest.mark.asyncio
-async def test_read_imei_and_setting_no_header() -> None:
+async def test_read_imei_only_keeps_leading_zeros(tmp_path: Path) -> None:
+    """
+    Test that IMEIs with leading zeros are not parsed as integers.
+    """
+    content = "012345678901234\n001234567890123"
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
+
+    result: List[str] = await read_imei_only(path)
+    assert result == ["012345678901234", "001234567890123"]
+
+
+@pytest.mark.asyncio
+async def test_read_imei_and_setting_no_header(tmp_path: Path) -> None:
     """
     Test reading IMEIs and settings from a file without a header.
     """
     content = "123456789012345,setting1\n987654321098765,setting2"
-    create_temp_csv(content, "test_imei_settings.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei_settings.csv")
 
     imeis: List[str]
     settings: List[str]
-    imeis, settings = await read_imei_and_setting("test_imei_settings.csv")
+    imeis, settings = await read_imei_and_setting(path)
     assert len(imeis) == 2
     assert len(settings) == 2
     assert imeis == ["123456789012345", "987654321098765"]
@@ -77,16 +140,16 @@ async def test_read_imei_and_setting_no_header() -> None:
 
 
 @pytest.mark.asyncio
-async def test_read_imei_and_setting_with_header() -> None:
+async def test_read_imei_and_setting_with_header(tmp_path: Path) -> None:
     """
     Test reading IMEIs and settings from a file with a header.
     """
     content = "IMEI,Setting\n123456789012345,setting1\n987654321098765,setting2"
-    create_temp_csv(content, "test_imei_settings.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei_settings.csv")
 
     imeis: List[str]
     settings: List[str]
-    imeis, settings = await read_imei_and_setting("test_imei_settings.csv")
+    imeis, settings = await read_imei_and_setting(path)
     assert len(imeis) == 2
     assert len(settings) == 2
     assert imeis == ["123456789012345", "987654321098765"]
@@ -94,22 +157,63 @@ async def test_read_imei_and_setting_with_header() -> None:
 
 
 @pytest.mark.asyncio
-async def test_imei_in_second_column() -> None:
+async def test_read_xlsx_with_header(tmp_path: Path) -> None:
+    """
+    Test reading IMEIs and settings from an Excel file with a header.
+    """
+    rows = [["IMEI", "Setting"], ["123456789012345", "setting1"], ["987654321098765", "setting2"]]
+    path = create_temp_xlsx(tmp_path, rows, "test_imei_settings.xlsx")
+
+    imeis, settings = await read_imei_and_setting(path)
+    assert imeis == ["123456789012345", "987654321098765"]
+    assert settings == ["setting1", "setting2"]
+    assert await read_imei_only(path) == ["123456789012345", "987654321098765"]
+
+
+@pytest.mark.asyncio
+async def test_read_xlsx_away_from_a1(tmp_path: Path) -> None:
+    """
+    Test that an Excel sheet whose data starts at B3 reads the same as one starting at A1.
+    """
+    rows = [["IMEI", "Setting"], ["123456789012345", "setting1"], ["987654321098765", "setting2"]]
+    path = create_temp_xlsx(tmp_path, rows, "test_imei_settings.xlsx", first_row=3, first_column=2)
+
+    imeis, settings = await read_imei_and_setting(path)
+    assert imeis == ["123456789012345", "987654321098765"]
+    assert settings == ["setting1", "setting2"]
+    assert await read_imei_only(path) == ["123456789012345", "987654321098765"]
+
+
+@pytest.mark.asyncio
+async def test_read_xlsx_numeric_cells(tmp_path: Path) -> None:
+    """
+    Test that IMEIs and settings stored as numbers in an Excel file are read as strings.
+    """
+    rows = [[123456789012345, 5], [987654321098765, 7]]
+    path = create_temp_xlsx(tmp_path, rows, "test_imei_settings.xlsx")
+
+    imeis, settings = await read_imei_and_setting(path)
+    assert imeis == ["123456789012345", "987654321098765"]
+    assert settings == ["5", "7"]
+
+
+@pytest.mark.asyncio
+async def test_imei_in_second_column(tmp_path: Path) -> None:
     """
     Test reading IMEIs from a file where IMEI is in the second column.
     """
     content = "ID,IMEI,Setting\n1,123456789012345,setting1\n2,987654321098765,setting2"
-    create_temp_csv(content, "test_imei_settings.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei_settings.csv")
 
     imeis: List[str]
     settings: List[str]
-    imeis, settings = await read_imei_and_setting("test_imei_settings.csv")
+    imeis, settings = await read_imei_and_setting(path)
     assert len(imeis) == 2
     assert imeis == ["123456789012345", "987654321098765"]
 
 
 @pytest.mark.asyncio
-async def test_case_sensitive_headers() -> None:
+async def test_case_sensitive_headers(tmp_path: Path) -> None:
     """
     Test that the function correctly handles different case variations of headers.
     """
@@ -118,11 +222,11 @@ async def test_case_sensitive_headers() -> None:
         content = (
             f"{header},Setting\n123456789012345,setting1\n987654321098765,setting2"
         )
-        create_temp_csv(content, "test_imei_settings.csv")
+        path = create_temp_csv(tmp_path, content, "test_imei_settings.csv")
 
         imeis: List[str]
         settings: List[str]
-        imeis, settings = await read_imei_and_setting("test_imei_settings.csv")
+        imeis, settings = await read_imei_and_setting(path)
         assert len(imeis) == 2
         assert imeis == ["123456789012345", "987654321098765"]
 
@@ -144,68 +248,100 @@ async def test_deduplicate_imeis() -> None:
 
 
 @pytest.mark.asyncio
-async def test_empty_file() -> None:
+async def test_empty_file(tmp_path: Path) -> None:
     """
     Test handling of an empty file.
     """
-    create_temp_csv("", "test_imei.csv")
+    path = create_temp_csv(tmp_path, "", "test_imei.csv")
 
     with pytest.raises(pd.errors.EmptyDataError, match="No columns to parse from file"):
-        await read_imei_only("test_imei.csv")
+        await read_imei_only(path)
 
 
 @pytest.mark.asyncio
-async def test_file_with_only_invalid_imeis() -> None:
+async def test_file_with_only_invalid_imeis(tmp_path: Path) -> None:
     """
     Test handling of a file with only invalid IMEIs.
     """
     content = "IMEI\n12345\n1234567890"
-    create_temp_csv(content, "test_imei.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
 
     with pytest.raises(ValueError, match="No valid IMEI numbers found in the file."):
-        await read_imei_only("test_imei.csv")
+        await read_imei_only(path)
 
 
 @pytest.mark.asyncio
-async def test_file_with_invalid_and_valid_imeis() -> None:
+async def test_file_with_invalid_and_valid_imeis(tmp_path: Path) -> None:
     """
     Test handling of a file with both invalid and valid IMEIs.
     """
     content = "IMEI\n12345\n1234567890123456\n987654321098765"
-    create_temp_csv(content, "test_imei.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
 
-    result: List[str] = await read_imei_only("test_imei.csv")
+    result: List[str] = await read_imei_only(path)
     assert len(result) == 2
     assert set(result) == {"123456789012345", "987654321098765"}
 
 
 @pytest.mark.asyncio
-async def test_file_without_imei_column() -> None:
+async def test_file_without_imei_column(tmp_path: Path) -> None:
     """
     Test handling of a file without an IMEI column.
     """
     content = "ID,Name\n1,John\n2,Jane"
-    create_temp_csv(content, "test_imei.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
 
     with pytest.raises(ValueError, match="No IMEI column found."):
-        await read_imei_only("test_imei.csv")
+        await read_imei_only(path)
 
 
 @pytest.mark.asyncio
-async def test_large_file() -> None:
+async def test_large_file(tmp_path: Path, large_imei_content: str) -> None:
     """
     Test handling of a large file with 100,000 IMEIs.
     """
-    imeis = [f"{i:015d}" for i in range(100000)]
-    content = "IMEI\n" + "\n".join(imeis)
-    create_temp_csv(content, "test_imei.csv")
+    path = create_temp_csv(tmp_path, large_imei_content, "test_imei.csv")
 
-    result: List[str] = await read_imei_only("test_imei.csv")
+    result: List[str] = await read_imei_only(path)
     assert len(result) == 100000
 
 
 @pytest.mark.asyncio
-async def test_imei_and_setting_mapping() -> None:
+async def test_read_imei_only_parses_only_the_imei_column(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that the IMEI column found in the probed rows is the only CSV column parsed, even when it is not first.
+    """
+    content = "Name,IMEI,Setting\nfirst,123456789012345,a\nsecond,987654321098765,b"
+    path = create_temp_csv(tmp_path, content, "test_imei.csv")
+    read_columns: List[Optional[List[int]]] = []
+    original_read_csv_chunks = get_data.read_csv_chunks
+
+    def read_csv_chunks(file_path: str, usecols: Optional[List[int]] = None):
+        read_columns.append(usecols)
+        return original_read_csv_chunks(file_path, usecols)
+
+    monkeypatch.setattr(get_data, "read_csv_chunks", read_csv_chunks)
+
+    result: List[str] = await read_imei_only(path)
+    assert result == ["123456789012345", "987654321098765"]
+    assert read_columns == [[1]]
+
+
+@pytest.mark.asyncio
+async def test_read_imei_only_deduplicates_across_chunks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that duplicates in different chunks of a CSV file are removed, keeping the first occurrence order.
+    """
+    imeis = ["111111111111111", "222222222222222", "111111111111111", "333333333333333", "222222222222222"]
+    path = create_temp_csv(tmp_path, "Setting,IMEI\n" + "\n".join(f"x,{imei}" for imei in imeis), "test_imei.csv")
+    monkeypatch.setattr(get_data, "CSV_CHUNK_SIZE", 2)
+
+    result: List[str] = await read_imei_only(path)
+    assert result == ["111111111111111", "222222222222222", "333333333333333"]
+
+
+@pytest.mark.asyncio
+async def test_imei_and_setting_mapping(tmp_path: Path) -> None:
     """
     Test correct mapping of IMEIs to settings.
     """
@@ -213,11 +349,11 @@ async def test_imei_and_setting_mapping() -> None:
 123456789012345,SettingA,Extra1
 987654321098765,SettingB,Extra2
 567890123456789,SettingC,Extra3"""
-    create_temp_csv(content, "test_imei_settings.csv")
+    path = create_temp_csv(tmp_path, content, "test_imei_settings.csv")
 
     imeis: List[str]
     settings: List[str]
-    imeis, settings = await read_imei_and_setting("test_imei_settings.csv")
+    imeis, settings = await read_imei_and_setting(path)
 
     assert len(imeis) == 3
     assert len(settings) == 3
@@ -235,3 +371,707 @@ async def test_imei_and_setting_mapping() -> None:
         assert (
                 setting == expected_setting
         ), f"Setting mismatch: {setting} != {expected_setting}"
+
+
+@pytest.mark.asyncio
+async def test_invalid_imei_keeps_settings_aligned(tmp_path: Path) -> None:
+    """
+    Test that a row with an invalid IMEI does not shift the settings of the rows after it.
+    """
+    content = "IMEI,Setting\n12345,SettingA\n987654321098765,SettingB\n567890123456789,SettingC"
+    path = create_temp_csv(tmp_path, content, "test_imei_settings.csv")
+
+    imeis: List[str]
+    settings: List[str]
+    imeis, settings = await read_imei_and_setting(path)
+    assert imeis == ["987654321098765", "567890123456789"]
+    assert settings == ["SettingB", "SettingC"]
+
+
+class StubListApi:
+    """
+    Stand-in for OneEdgeApi that answers list commands from a fixed list of responses.
+    """
+
+    def __init__(self, responses: List[dict]) -> None:
+        self.session_id = "test-session"
+        self.responses = responses
+        self.calls: List[dict] = []
+
+    async def run_command(self, command: dict) -> dict:
+        self.calls.append(command)
+        return self.responses[min(len(self.calls), len(self.responses)) - 1]
+
+
+@pytest.mark.asyncio
+async def test_failed_profile_list_is_not_cached() -> None:
+    """
+    Test that a failed profile list raises and is asked for again on the next lookup.
+    """
+    clear_lookup_cache()
+    api = StubListApi([
+        {"success": False, "errorCodes": [-90000]},
+        {"success": True, "params": {"result": [{"name": "Standard", "id": "p1"}]}},
+    ])
+
+    with pytest.raises(OneEdgeApiError):
+        await get_profile_id(api, "Standard")
+    assert await get_profile_id(api, "Standard") == "p1"
+    clear_lookup_cache()
+
+
+@pytest.mark.asyncio
+async def test_profile_list_stops_when_offset_is_ignored() -> None:
+    """
+    Test that listing stops when the server keeps returning the same full page, and skips malformed entries.
+    """
+    clear_lookup_cache()
+    page = [{"name": f"profile{i}", "id": f"p{i}"} for i in range(LIST_PAGE_SIZE - 1)] + [{"id": "no-name"}]
+    api = StubListApi([{"success": True, "params": {"result": page}}])
+
+    assert await get_profile_id(api, "profile3") == "p3"
+    assert len(api.calls) == 2
+    clear_lookup_cache()
+
+
+def test_tag_commands_emit_tag_lists() -> None:
+    """
+    Test that tag commands send the tags as a list, as given by the caller.
+    """
+    commands = create_commands_tags(["123456789012345"], ["sensor", "active"])
+    assert commands == {
+        "1": {"command": "thing.tag.add", "params": {"thingKey": "123456789012345", "tags": ["sensor", "active"]}}
+    }
+    assert create_commands_delete_tags("k1", ["old"])["1"]["params"]["tags"] == ["old"]
+
+
+class StubBatchApi:
+    """
+    Stand-in for OneEdgeApi that answers each batch and fails the batches holding given keys.
+    """
+
+    def __init__(self, failing_keys: Tuple[str, ...] = ()) -> None:
+        self.failing_keys = failing_keys
+        self.batches: List[List[str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def run_commands(self, commands: dict) -> dict:
+        self.batches.append(list(commands))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        if any(key in self.failing_keys for key in commands):
+            raise OneEdgeApiError("Failed to receive a response from the API.")
+        return {"success": True, "errorCodes": [], **{key: {"success": True} for key in commands}}
+
+
+def make_commands(count: int) -> dict:
+    """
+    Builds `count` numbered dummy commands.
+    """
+    return {str(i): {"command": "thing.tag.add"} for i in range(1, count + 1)}
+
+
+@pytest.mark.asyncio
+async def test_process_commands_merges_batches() -> None:
+    """
+    Test that all batches succeed, results are merged by key and concurrency stays bounded.
+    """
+    api = StubBatchApi()
+    results = await process_commands(api, make_commands(10), batch_size=3, concurrency=2)
+
+    assert api.batches == [["1", "2", "3"], ["4", "5", "6"], ["7", "8", "9"], ["10"]]
+    assert api.max_in_flight <= 2
+    assert results["success"] is True
+    assert results["errorCodes"] == []
+    assert all(results[str(i)] == {"success": True} for i in range(1, 11))
+
+
+@pytest.mark.asyncio
+async def test_process_commands_marks_failed_batch() -> None:
+    """
+    Test that the keys of a failed batch are marked unsuccessful and the overall flag is cleared.
+    """
+    api = StubBatchApi(failing_keys=("4",))
+    results = await process_commands(api, make_commands(6), batch_size=3)
+
+    assert results["success"] is False
+    assert [results[key]["success"] for key in ("1", "2", "3")] == [True, True, True]
+    assert [results[key]["success"] for key in ("4", "5", "6")] == [False, False, False]
+
+
+@pytest.mark.asyncio
+async def test_process_commands_raises_when_every_batch_fails() -> None:
+    """
+    Test that the error is raised when no batch succeeds.
+    """
+    api = StubBatchApi(failing_keys=("1", "3"))
+    with pytest.raises(OneEdgeApiError):
+        await process_commands(api, make_commands(4), batch_size=2)
+
+
+class FakeResponse:
+    """
+    Minimal aiohttp response: a status, headers and a raw body, or the exception reading it raises.
+    """
+
+    def __init__(
+            self, status: int = 200, body: Union[bytes, Exception] = b"{}", headers: Optional[dict] = None
+    ) -> None:
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+    async def read(self) -> bytes:
+        if isinstance(self.body, Exception):
+            raise self.body
+        return self.body
+
+    async def __aenter__(self) -> "FakeResponse":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
+
+
+class FakeSession:
+    """
+    Minimal aiohttp session that replays a list of responses, or raises the exceptions among them.
+    """
+
+    closed = False
+
+    def __init__(self, responses: List[Union[FakeResponse, Exception]]) -> None:
+        self.responses = list(responses)
+        self.posts = 0
+        self.payloads: List[dict] = []
+        self.bodies: List[bytes] = []
+        self.headers: List[dict] = []
+
+    def post(self, url: str, data: bytes, headers: dict) -> FakeResponse:
+        self.posts += 1
+        self.bodies.append(data)
+        self.headers.append(headers)
+        if headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        self.payloads.append(orjson.loads(data))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_api(
+        responses: List[Union[FakeResponse, Exception]], monkeypatch: pytest.MonkeyPatch
+) -> Tuple[OneEdgeApi, FakeSession, List[float]]:
+    """
+    Builds an OneEdgeApi on a FakeSession, recording the retry delays instead of sleeping.
+    """
+    session = FakeSession(responses)
+    delays: List[float] = []
+
+    async def no_sleep(delay: float) -> None:
+        delays.append(delay)
+
+    monkeypatch.setattr(oneEdgeApi.asyncio, "sleep", no_sleep)
+    return OneEdgeApi("http://oneedge.test/api", session=session), session, delays
+
+
+API_URL = "http://oneedge.test/api"
+LOGIN_RESPONSE = FakeResponse(body=b'{"auth": {"success": true, "params": {"sessionId": "new"}}}')
+SUCCESS_RESPONSE = FakeResponse(body=b'{"1": {"success": true}}')
+
+
+def connect_error() -> aiohttp.ClientConnectorError:
+    """
+    Builds the error aiohttp raises when no connection to the API host could be made.
+    """
+    connection_key = SimpleNamespace(host="oneedge.test", port=443, ssl=True)
+    return aiohttp.ClientConnectorError(connection_key, ConnectionRefusedError(111, "Connection refused"))
+
+
+@pytest.mark.asyncio
+async def test_send_payload_retries_refused_requests(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that requests the API refused or never received are retried: 429, 503 with Retry-After,
+    -90005 and failures to connect.
+    """
+    api, session, delays = make_api([
+        FakeResponse(429, headers={"Retry-After": "2"}),
+        FakeResponse(503, headers={"Retry-After": "1"}),
+        FakeResponse(body=b'{"success": false, "errorCodes": [-90005]}'),
+        connect_error(),
+        aiohttp.ConnectionTimeoutError("connect timed out"),
+        FakeResponse(body=b'{"1": {"success": true}}'),
+    ], monkeypatch)
+    api.REQUEST_RETRIES = 6
+
+    result = await api.run_command({"command": "session.info"})
+    assert result == {"success": True}
+    assert session.posts == 6
+    assert delays[:2] == [2.0, 1.0]
+    assert api.last_error is None
+
+
+@pytest.mark.asyncio
+async def test_send_payload_gives_up_after_request_retries(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that OneEdgeApiError is raised once every attempt was refused, and other API errors are not retried.
+    """
+    api, session, _ = make_api([FakeResponse(429)] * 3, monkeypatch)
+    api.REQUEST_RETRIES = 3
+    with pytest.raises(OneEdgeApiError):
+        await api.run_command({"command": "session.info"})
+    assert session.posts == 3
+
+    api, session, _ = make_api([FakeResponse(body=b'{"success": false, "errorCodes": [-90041]}')], monkeypatch)
+    result = await api.run_command({"command": "session.info"})
+    assert result == {"success": False, "errorCodes": [-90041]}
+    assert session.posts == 1
+
+
+@pytest.mark.asyncio
+async def test_send_payload_does_not_resend_received_requests(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that a request which may have reached the API is sent only once, so its commands cannot
+    be applied twice.
+    """
+    possibly_received = [
+        FakeResponse(body=asyncio.TimeoutError()),
+        FakeResponse(body=aiohttp.ServerDisconnectedError()),
+        asyncio.TimeoutError(),
+        FakeResponse(500, body=b"<html>Internal Server Error</html>"),
+        FakeResponse(503, body=b"<html>Service Unavailable</html>"),
+        FakeResponse(body=b"not json"),
+        FakeResponse(body=b"[]"),
+    ]
+    for response in possibly_received:
+        api, session, delays = make_api([response, FakeResponse(body=b'{"1": {"success": true}}')], monkeypatch)
+        with pytest.raises(OneEdgeApiError):
+            await api.run_command({"command": "thing.delete", "params": {"key": "1"}})
+        assert session.posts == 1
+        assert delays == []
+
+
+@pytest.mark.asyncio
+async def test_large_payloads_are_gzip_compressed(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that bodies reaching gzip_min_size are sent compressed with Content-Encoding: gzip, and
+    smaller ones as plain JSON.
+    """
+    session = FakeSession([SUCCESS_RESPONSE, SUCCESS_RESPONSE])
+    api = OneEdgeApi("http://oneedge.test/api", session=session, gzip_min_size=1024)
+    small = {"command": "thing.find", "params": {"key": "1"}}
+    large = {"command": "thing.tag.add", "params": {"key": "1", "tags": ["tag"] * 500}}
+
+    await api.run_command(small)
+    await api.run_command(large)
+
+    assert session.headers[0] == OneEdgeApi.JSON_HEADERS
+    assert orjson.loads(session.bodies[0])["1"] == small
+    assert session.headers[1]["Content-Encoding"] == "gzip"
+    assert session.bodies[1][:2] == b"\x1f\x8b"
+    assert len(session.bodies[1]) < len(orjson.dumps(session.payloads[1]))
+    assert session.payloads[1]["1"] == large
+
+    # Without a threshold every body is sent as plain JSON
+    session = FakeSession([SUCCESS_RESPONSE])
+    await OneEdgeApi("http://oneedge.test/api", session=session).run_command(large)
+    assert session.headers[0] == OneEdgeApi.JSON_HEADERS
+
+
+class SlowResponse(FakeResponse):
+    """
+    FakeResponse that lets other tasks run before its body arrives, as a real request would.
+    """
+
+    async def read(self) -> bytes:
+        await asyncio.sleep(0)
+        return await super().read()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reauthentication_logs_in_once() -> None:
+    """
+    Test that two tasks whose session expired at the same time share a single new login.
+    """
+    expired = SlowResponse(body=b'{"1": {"success": false, "errorCodes": [-90000]}}')
+    login = SlowResponse(body=LOGIN_RESPONSE.body)
+    verified = SlowResponse(body=SUCCESS_RESPONSE.body)
+    session = FakeSession([expired, expired, login, verified, login, verified])
+    api = OneEdgeApi("http://oneedge.test/api", session=session)
+    api.session_id = "old"
+
+    async def run_and_reauthenticate() -> bool:
+        result = await api.run_command({"command": "thing.find", "params": {"key": "1"}})
+        if result["errorCodes"] == [-90000]:
+            # An expired session is dropped before logging in again, as _handle_auth_response does
+            api.session_id = None
+        return await api.authenticate_user("user", "secret")
+
+    assert await asyncio.gather(run_and_reauthenticate(), run_and_reauthenticate()) == [True, True]
+
+    logins = [payload for payload in session.payloads if "auth" in payload and "command" in payload["auth"]]
+    assert len(logins) == 1
+    assert session.posts == 4
+    assert api.session_id == "new"
+
+
+def test_retry_after_delay() -> None:
+    """
+    Test that Retry-After seconds are honoured up to MAX_RETRY_DELAY, with backoff otherwise.
+    """
+    api = OneEdgeApi("http://oneedge.test/api")
+    assert api._retry_after_delay("3", 0) == 3.0
+    assert api._retry_after_delay("3600", 0) == api.MAX_RETRY_DELAY
+    assert api._retry_after_delay("-1", 0) == 0.0
+    assert api.REQUEST_RETRY_DELAY <= api._retry_after_delay(None, 0) <= api.REQUEST_RETRY_DELAY + 0.5
+    assert 4 * api.REQUEST_RETRY_DELAY <= api._retry_after_delay("soon", 2) <= 4 * api.REQUEST_RETRY_DELAY + 0.5
+
+
+@pytest.fixture
+def session_cache_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """
+    Fixture pointing the session cache of bulk_changes at a per-test file.
+    """
+    cache_file = tmp_path / "cache" / "session.json"
+    monkeypatch.setattr(bulk_changes, "SESSION_CACHE_FILE", cache_file)
+    return cache_file
+
+
+def test_session_cache_round_trip_and_mode(session_cache_file: Path) -> None:
+    """
+    Test that a stored session is found again, per URL, in a file only the owner can read.
+    """
+    bulk_changes._store_cached_session("https://a.test/api", "session-a")
+    bulk_changes._store_cached_session("https://b.test/api", "session-b")
+
+    assert bulk_changes._load_cached_session("https://a.test/api") == "session-a"
+    assert bulk_changes._load_cached_session("https://b.test/api") == "session-b"
+    assert session_cache_file.stat().st_mode & 0o777 == 0o600
+    assert not session_cache_file.with_suffix(".tmp").exists()
+
+
+def test_session_cache_ignores_expired_entry(session_cache_file: Path) -> None:
+    """
+    Test that a cached session past its expiry is not reused.
+    """
+    bulk_changes._store_cached_session("https://a.test/api", "session-a", ttl=-1)
+    assert bulk_changes._load_cached_session("https://a.test/api") is None
+
+
+def test_session_cache_tolerates_corrupt_file(session_cache_file: Path) -> None:
+    """
+    Test that an unreadable cache file is treated as empty and replaced on the next store.
+    """
+    session_cache_file.parent.mkdir(parents=True)
+    session_cache_file.write_bytes(b"{not json")
+
+    assert bulk_changes._load_cached_session("https://a.test/api") is None
+    bulk_changes._store_cached_session("https://a.test/api", "session-a")
+    assert bulk_changes._load_cached_session("https://a.test/api") == "session-a"
+
+
+def use_fake_api(responses: List[FakeResponse], monkeypatch: pytest.MonkeyPatch) -> FakeSession:
+    """
+    Points bulk_changes at a FakeSession replaying the responses, with credentials in the environment.
+    """
+    session = FakeSession(responses)
+    monkeypatch.setenv("API_URL", API_URL)
+    monkeypatch.setenv("TELIT_USERNAME", "user")
+    monkeypatch.setenv("TELIT_PASSWORD", "secret")
+    monkeypatch.setattr(
+        bulk_changes, "OneEdgeApi", lambda url, **kwargs: OneEdgeApi(url, session=session, **kwargs)
+    )
+    return session
+
+
+@pytest.mark.asyncio
+async def test_new_session_ends_replaced_session(
+        session_cache_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Test that --new-session logs in, caches the new session and ends the cached one it replaces.
+    """
+    bulk_changes._store_cached_session(API_URL, "old")
+    session = use_fake_api([LOGIN_RESPONSE, SUCCESS_RESPONSE, SUCCESS_RESPONSE], monkeypatch)
+
+    api = await bulk_changes.authenticate_user(new_session=True)
+
+    assert api.session_id == "new"
+    assert bulk_changes._load_cached_session(API_URL) == "new"
+    assert session.payloads[-1]["1"] == {"command": "session.end", "params": {"id": "old"}}
+
+
+@pytest.mark.asyncio
+async def test_execute_command_ends_sessions_it_cannot_cache(
+        tmp_path: Path, session_cache_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Test that a cached session is kept alive for the next run, and an uncached one is ended.
+    """
+    async def no_commands() -> None:
+        return None
+
+    session = use_fake_api([LOGIN_RESPONSE, SUCCESS_RESPONSE], monkeypatch)
+    assert await bulk_changes.execute_command(no_commands) is None
+    assert session.posts == 2
+
+    # The cache directory cannot be created under a regular file
+    (tmp_path / "not_a_directory").write_text("")
+    monkeypatch.setattr(bulk_changes, "SESSION_CACHE_FILE", tmp_path / "not_a_directory" / "session.json")
+    session = use_fake_api([LOGIN_RESPONSE, SUCCESS_RESPONSE, SUCCESS_RESPONSE], monkeypatch)
+    assert await bulk_changes.execute_command(no_commands, new_session=True) is None
+    assert session.payloads[-1]["1"] == {"command": "session.end", "params": {"id": "new"}}
+
+
+@pytest.mark.asyncio
+async def test_execute_command_reads_file_after_credential_prompts(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that the file is only read alongside the login when no credential prompt is needed.
+    """
+    events: List[str] = []
+
+    async def authenticate_user(new_session: bool = False) -> None:
+        events.append("login started")
+        await asyncio.sleep(0)
+        events.append("login finished")
+
+    async def read_file() -> None:
+        events.append("file read")
+
+    monkeypatch.setattr(bulk_changes, "load_env", lambda: None)
+    monkeypatch.setattr(bulk_changes, "authenticate_user", authenticate_user)
+
+    monkeypatch.delenv("TELIT_USERNAME", raising=False)
+    await bulk_changes.execute_command(read_file)
+    assert events == ["login started", "login finished", "file read"]
+
+    events.clear()
+    monkeypatch.setenv("TELIT_USERNAME", "user")
+    await bulk_changes.execute_command(read_file)
+    assert events == ["login started", "file read", "login finished"]
+
+
+def test_sql_string_list_escapes_quotes() -> None:
+    """
+    Test that values are rendered as SQL string literals with embedded quotes doubled.
+    """
+    assert sql_string_list(["123", "4'5", "O''Brien"]) == "'123','4''5','O''''Brien'"
+    assert sql_string_list([]) == ""
+
+
+def test_construct_undeploy_script() -> None:
+    """
+    Test the exact text of the undeploy script once the IMEI list is filled in.
+    """
+    script = construct_undeploy_script("devices").format(sql_string_list(["1", "2"]))
+    assert script == (
+        "BEGIN;\n"
+        "SELECT COUNT(*) FROM devices WHERE imei IN ('1','2');\n"
+        "DELETE FROM devices WHERE imei IN ('1','2');\n"
+        "COMMIT;\n"
+    )
+
+
+def test_undeploy_process_skips_empty_imei_list(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Test that an empty IMEI list returns before checking the VPN or running any SQL.
+    """
+    def fail(*args, **kwargs):
+        raise AssertionError("undeploy_process should not get this far")
+
+    monkeypatch.setattr(undeploy_process, "reload_config", fail)
+    monkeypatch.setattr(undeploy_process, "is_vpn_connected", fail)
+    monkeypatch.setattr(undeploy_process, "execute_sql_query", fail)
+
+    undeploy_process.undeploy_process([])
+
+
+@pytest.fixture
+def fake_clock(monkeypatch: pytest.MonkeyPatch) -> dict:
+    """
+    Fixture replacing time.monotonic and asyncio.sleep in oneEdgeApi with a clock that only
+    moves when a coroutine sleeps, recording each delay and the most concurrent sleepers.
+    """
+    real_sleep = asyncio.sleep
+    clock = {"now": 1000.0, "delays": [], "sleeping": 0, "max_sleeping": 0}
+
+    async def fake_sleep(delay: float) -> None:
+        clock["delays"].append(delay)
+        clock["sleeping"] += 1
+        clock["max_sleeping"] = max(clock["max_sleeping"], clock["sleeping"])
+        # Let any other waiting coroutine run before time moves on
+        await real_sleep(0)
+        clock["now"] += delay
+        clock["sleeping"] -= 1
+
+    monkeypatch.setattr(oneEdgeApi.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(oneEdgeApi.asyncio, "sleep", fake_sleep)
+    return clock
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_burst_then_refill(fake_clock: dict) -> None:
+    """
+    Test that a full bucket allows a burst without waiting, then one token per 1 / rate seconds.
+    """
+    bucket = oneEdgeApi.TokenBucket(rate=4.0, capacity=3)
+
+    for _ in range(3):
+        await bucket.acquire()
+    assert fake_clock["delays"] == []
+
+    await bucket.acquire()
+    assert fake_clock["delays"] == [pytest.approx(0.25)]
+
+    # Tokens saved up while idle never exceed the capacity
+    fake_clock["now"] += 60
+    fake_clock["delays"].clear()
+    for _ in range(4):
+        await bucket.acquire()
+    assert fake_clock["delays"] == [pytest.approx(0.25)]
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_serializes_concurrent_acquires(fake_clock: dict) -> None:
+    """
+    Test that concurrent callers wait for tokens one at a time, so the rate holds across them.
+    """
+    bucket = oneEdgeApi.TokenBucket(rate=2.0, capacity=2)
+    start = fake_clock["now"]
+
+    await asyncio.gather(*(bucket.acquire() for _ in range(6)))
+
+    assert fake_clock["max_sleeping"] == 1
+    assert fake_clock["delays"] == [pytest.approx(0.5)] * 4
+    assert fake_clock["now"] - start == pytest.approx(2.0)
+
+
+@pytest.mark.asyncio
+async def test_verify_auth_state_cache(fake_clock: dict) -> None:
+    """
+    Test that a verified session is trusted for VERIFY_CACHE_TTL seconds, and that a failed
+    verification clears the cache.
+    """
+    failed = FakeResponse(body=b'{"1": {"success": false, "errorCodes": [-90000]}}')
+    session = FakeSession([SUCCESS_RESPONSE, SUCCESS_RESPONSE, failed, SUCCESS_RESPONSE])
+    api = OneEdgeApi("http://oneedge.test/api", session=session)
+    # The cache's default timer was bound at import, so give it the fake clock
+    api._verified_cache = TTLCache(maxsize=1, ttl=api.VERIFY_CACHE_TTL, timer=lambda: fake_clock["now"])
+    api.session_id = "session-a"
+
+    await api.verify_auth_state()
+    await api.verify_auth_state()
+    assert session.posts == 1
+    assert api.auth_state == AuthState.AUTHENTICATED
+
+    fake_clock["now"] += api.VERIFY_CACHE_TTL
+    await api.verify_auth_state()
+    assert session.posts == 2
+
+    api.session_id = "session-b"
+    await api.verify_auth_state()
+    assert session.posts == 3
+    assert api.auth_state == AuthState.NOT_AUTHENTICATED
+    assert len(api._verified_cache) == 0
+
+    # session-a was verified moments ago, but the failure means it is asked about again
+    api.session_id = "session-a"
+    await api.verify_auth_state()
+    assert session.posts == 4
+
+
+@pytest.mark.asyncio
+async def test_session_expires_after_session_ttl(fake_clock: dict) -> None:
+    """
+    Test that a session past SESSION_TTL is treated as unauthenticated, so the next login sends
+    the credentials again.
+    """
+    session = FakeSession([LOGIN_RESPONSE, SUCCESS_RESPONSE])
+    api = OneEdgeApi("http://oneedge.test/api", session=session)
+    api.session_id = "old"
+
+    fake_clock["now"] += api.SESSION_TTL - 1
+    assert api.session_id == "old"
+    assert api.auth_state == AuthState.AUTHENTICATED
+
+    fake_clock["now"] += 1
+    assert api.session_id is None
+    assert api.auth_state == AuthState.NOT_AUTHENTICATED
+
+    assert await api.authenticate_user("user", "secret")
+    assert session.payloads[0]["auth"]["command"] == "api.authenticate"
+    assert api.session_id == "new"
+
+
+@pytest.mark.asyncio
+async def test_injected_session_and_connector_stay_open() -> None:
+    """
+    Test that a session or connector passed in by the caller is used, and left open by aclose.
+    """
+    async with aiohttp.ClientSession() as shared_session:
+        api = OneEdgeApi("http://oneedge.test/api", session=shared_session)
+        assert await api._get_session() is shared_session
+        await api.aclose()
+        assert not shared_session.closed
+        assert await api._get_session() is shared_session
+
+    connector = aiohttp.TCPConnector()
+    try:
+        async with OneEdgeApi("http://oneedge.test/api", connector=connector) as api:
+            own_session = await api._get_session()
+            assert own_session.connector is connector
+        assert own_session.closed
+        assert not connector.closed
+    finally:
+        await connector.close()
+
+
+@pytest.mark.asyncio
+async def test_prewarm_heads_the_endpoint_and_can_be_cancelled() -> None:
+    """
+    Test that prewarm sends a HEAD request, and that cancelling it mid-request raises nothing
+    else and gives its connection back.
+    """
+    methods: List[str] = []
+    second_request_started = asyncio.Event()
+    release_second_request = asyncio.Event()
+
+    async def handler(request: web.Request) -> web.Response:
+        methods.append(request.method)
+        if len(methods) == 2:
+            second_request_started.set()
+            await release_second_request.wait()
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_route("HEAD", "/api", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    server_socket = socket.socket()
+    server_socket.bind(("127.0.0.1", 0))
+    port = server_socket.getsockname()[1]
+    await web.SockSite(runner, server_socket).start()
+
+    # A single connection, so a leaked one would make the last prewarm wait forever
+    connector = aiohttp.TCPConnector(limit=1)
+    try:
+        async with OneEdgeApi(f"http://127.0.0.1:{port}/api", connector=connector) as api:
+            await api.prewarm()
+            assert methods == ["HEAD"]
+
+            prewarm = asyncio.create_task(api.prewarm())
+            await second_request_started.wait()
+            prewarm.cancel()
+            await asyncio.gather(prewarm, return_exceptions=True)
+            assert prewarm.cancelled()
+
+            release_second_request.set()
+            await asyncio.wait_for(api.prewarm(), timeout=5)
+            assert methods == ["HEAD", "HEAD", "HEAD"]
+    finally:
+        await connector.close()
+        await runner.cleanup()